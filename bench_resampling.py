@@ -0,0 +1,78 @@
+"""
+Resampling Benchmark
+Compares scipy.ndimage.zoom (utils.resize_image_scipy) with the torch resampling engine
+Usage: python bench_resampling.py [n_volumes] [n_threads]
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from dataloaders.resampling import resample_volume, resample_volumes, set_num_threads
+from utils import resize_image_scipy
+
+SRC_SHAPE = (90, 512, 512)  # typical abdominal CT volume
+NEW_SHAPE = (90, 256, 256)
+
+
+def timeit(fn, n_repeats=3):
+    times = []
+    for _ in range(n_repeats):
+        tic = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - tic)
+    return min(times)
+
+
+def check_grid(src_shape, new_shape):
+    """
+    Labels must be sampled on the grid of the images: along every axis, the source index of
+    a label voxel is the nearest to the source coordinate of the image voxel
+    """
+    for axis, n in enumerate(src_shape):
+        shape = [1] * len(src_shape)
+        shape[axis] = n
+        ramp = np.broadcast_to(np.arange(n).reshape(shape), src_shape)
+        coords = resample_volume(ramp.astype(np.float32), new_shape)
+        indices = resample_volume(ramp.astype(np.int64), new_shape, True)
+        shift = np.abs(indices - coords).max()
+        assert shift <= 0.5 + 1e-3, f"labels shifted by {shift} voxels along axis {axis}"
+
+
+def main(n_volumes=4, n_threads=4):
+    set_num_threads(n_threads)
+    rng = np.random.default_rng(0)
+    images = [rng.random(SRC_SHAPE, dtype=np.float32) for _ in range(n_volumes)]
+    labels = [
+        rng.choice([0, 200, 500, 600], SRC_SHAPE).astype(np.uint16)
+        for _ in range(n_volumes)
+    ]
+
+    for name, vols, is_label in (("image", images, False), ("label", labels, True)):
+        t_scipy = timeit(lambda: [resize_image_scipy(v, NEW_SHAPE) for v in vols])
+        t_torch = timeit(
+            lambda: [resample_volume(v, NEW_SHAPE, is_label) for v in vols]
+        )
+        t_batch = timeit(lambda: resample_volumes(vols, NEW_SHAPE, is_label))
+        print(
+            f"{name}: {n_volumes} x {SRC_SHAPE} -> {NEW_SHAPE}, "
+            f"scipy {t_scipy:.2f}s, torch {t_torch:.2f}s ({t_scipy / t_torch:.1f}x), "
+            f"torch batched {t_batch:.2f}s ({t_scipy / t_batch:.1f}x)"
+        )
+
+    check_grid(SRC_SHAPE, NEW_SHAPE)
+    check_grid(SRC_SHAPE, (31, 256, 256))  # test volumes
+    print("labels and images resized on the same grid")
+
+    # interpolated labels take values that are not classes, nearest neighbour does not
+    src = set(np.unique(labels[0]))
+    print(
+        "label values not in the source volume: "
+        f"scipy {sorted(set(np.unique(resize_image_scipy(labels[0], NEW_SHAPE))) - src)[:5]}, "
+        f"torch {sorted(set(np.unique(resample_volume(labels[0], NEW_SHAPE, True))) - src)}"
+    )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
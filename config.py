@@ -37,6 +37,12 @@ def cfg():
     seed = 2021
     gpu_id = 0
     num_workers = 0  # 0 for debugging.
+    n_load_workers = 8  # processes reading volumes at startup, 1 for debugging.
+    resample_threads = 4  # CPU threads resizing volumes in each load worker process and in build_shards
+    n_prefetch = 2  # training batches prepared ahead in a background thread, 0 to disable
+    n_elastic_fields = 0  # >0: draw elastic displacements from a bank of this many precomputed fields
+    elastic_bank_path = None  # .npy file of the displacement bank, loaded if it exists, written otherwise
+    batch_augment = False  # augment collated batches on the training device instead of per episode in the loader
     mode = "train"
 
     ## dataset
@@ -47,13 +53,25 @@ def cfg():
         n_sv = 1000
     else:
         n_sv = 5000
+    sv_compactness = 0.1  # SLIC compactness of the supervoxels (on normalized intensities)
     min_size = 200
     max_slices = 3
+    roi_size = None  # crop training episodes to roi_size x roi_size around the foreground (e.g. 128), None for full slices
+    roi_margin = 0  # ROI crop: context kept around the foreground, in pixels
+    episode_weighting = "uniform"  # 'uniform' over all valid episodes, or 'class' for balanced classes
+    episode_sampling = "random"  # 'random' by episode_weighting, or 'loss' to favour (volume, class) pairs with a high loss
+    sampling_temperature = 1.0  # loss-aware sampling: sharpness of the loss distribution (lower is sharper)
+    sampling_floor = 0.2  # loss-aware sampling: share of episodes still drawn by episode_weighting
+    loss_momentum = 0.9  # loss-aware sampling: running average of the loss of each (volume, class)
     use_gt = False  # True - use ground truth as training label, False - use supervoxel as training label
     eval_fold = 0  # (0-4) for 5-fold cross-validation
     test_label = [10, 14]  # for evaluation
     supp_idx = 0  # choose which case as the support set for evaluation, (0-4) for 'CHAOST2', (0-7) for 'CMR'
     n_part = 3  # for evaluation, i.e. 3 chunks
+    test_cache_mb = 4096  # for evaluation, resized volumes kept in memory across test classes
+    n_test_prefetch = 2  # for evaluation, query volumes read ahead in a background thread, 0 to disable
+    query_batch_mb = 2048  # for evaluation, activation memory budget setting how many query slices are segmented at once
+    cache_dir = "./cache"  # resized volumes as memory-mapped .npy files, None to read NIfTI every run
 
     ## training
     n_steps = 1000
@@ -68,15 +86,20 @@ def cfg():
     print_interval = 1000
     save_snapshot_every = 1000
     max_iters_per_load = 1000  # epoch size, interval for reloading the dataset
+    max_volumes_in_memory = None  # rolling window of K random volumes reloaded every epoch, None for all
+    shard_dir = None  # shards written by 'train_main.py build_shards' (one per fold), None to read volumes
+    shard_size_mb = 1024
+    episodes_per_volume = 8  # episodes drawn from each volume of a shard while it is streamed
+    episode_bank = None  # episodes written by 'train_main.py build_episode_bank', None to sample online
+    n_bank_episodes = 100000
+    feature_cache = None  # encoder features written by 'train_main.py build_feature_cache', trains the head only
+    n_feature_augment = 0  # fixed augmentations per volume encoded in addition to the original
     alpha = 0.9  # dual-scale
 
     # Network
     # reload_model_path =
     reload_model_path = None
 
-    # Prototype Refinement
-    n_iters = 7
-
     optim_type = "sgd"
     optim = {
         "lr": 1e-3,
@@ -0,0 +1,210 @@
+"""
+Batched Augmentation
+Gamma and affine + elastic augmentation of collated episode batches on tensors (CPU or GPU),
+the counterpart of EpisodeMixin.gamma_tansform and EpisodeMixin.geom_transform
+"""
+
+import torch
+import torch.nn.functional as F
+
+
+def get_affine_matrices(params, size):
+    """
+    Pixel-space 3 x 3 affine matrices (output pixel -> input pixel) of a batch of transforms
+    composed as RandomAffine.build_M: rotation, translation, shear, then isotropic zoom, all
+    centred on the image
+
+    Args:
+        params: K x 5 tensor of (rotation [deg], tx, ty [pixels], shear [deg], zoom)
+        size: (H, W)
+    """
+    rot, tx, ty, shear, zoom = params.unbind(dim=1)
+    cx, cy = size[0] / 2, size[1] // 2  # centre as in get_rotation_matrix
+    eye = torch.eye(3, dtype=params.dtype, device=params.device)
+    eye = eye.repeat(len(params), 1, 1)
+
+    # cv2.getRotationMatrix2D
+    a, b = torch.cos(torch.deg2rad(rot)), torch.sin(torch.deg2rad(rot))
+    m_rot = eye.clone()
+    m_rot[:, 0, 0], m_rot[:, 0, 1], m_rot[:, 0, 2] = a, b, (1 - a) * cx - b * cy
+    m_rot[:, 1, 0], m_rot[:, 1, 1], m_rot[:, 1, 2] = -b, a, b * cx + (1 - a) * cy
+
+    m_shift = eye.clone()
+    m_shift[:, 0, 2], m_shift[:, 1, 2] = tx, ty
+
+    theta = torch.deg2rad(shear)
+    m_shear = eye.clone()
+    m_shear[:, 0, 1], m_shear[:, 1, 1] = -torch.sin(theta), torch.cos(theta)
+
+    m_zoom = eye.clone()
+    m_zoom[:, 0, 0], m_zoom[:, 1, 1] = zoom, zoom
+    m_zoom[:, 0, 2], m_zoom[:, 1, 2] = (1 - zoom) * cx, (1 - zoom) * cy
+
+    # forward transform (input -> output, as for cv2.warpAffine), inverted for sampling
+    forward = m_zoom @ m_shear @ m_shift @ m_rot
+    return torch.linalg.inv(forward)
+
+
+def gaussian_kernel(sigma, device=None):
+    size = int(4 * sigma) | 1  # as elastic_transform_nd
+    x = torch.arange(size, dtype=torch.float32, device=device) - size // 2
+    kernel = torch.exp(-(x**2) / (2 * sigma**2))
+    return kernel / kernel.sum()
+
+
+def smooth(noise, sigma):
+    """
+    Separable Gaussian blur of K x C x H x W fields (reflected borders, as cv2.GaussianBlur)
+    """
+    kernel = gaussian_kernel(sigma, noise.device)
+    pad = len(kernel) // 2
+    n_channels = noise.shape[1]
+    noise = F.pad(noise, (pad, pad, pad, pad), mode="reflect")
+    noise = F.conv2d(
+        noise, kernel.view(1, 1, -1, 1).repeat(n_channels, 1, 1, 1), groups=n_channels
+    )
+    return F.conv2d(
+        noise, kernel.view(1, 1, 1, -1).repeat(n_channels, 1, 1, 1), groups=n_channels
+    )
+
+
+class BatchAugment(object):
+    """
+    Augments a collated episode batch (see episode_collate), replacing the per-episode numpy
+    augmentation. Every episode gets a gamma transform of its support or its query images, and
+    an affine + elastic transform (one per slice) of its support or its query slices
+    All transforms of a batch are applied with one grid_sample: bilinear for images, nearest
+    for masks
+    """
+
+    def __init__(
+        self,
+        rotate=5,
+        shift=(5, 5),
+        shear=5,
+        scale=(0.9, 1.2),
+        alpha=10,
+        sigma=5,
+        gamma_range=(0.5, 1.5),
+        seed=None,
+    ):
+        self.rotate = rotate
+        self.shift = shift
+        self.shear = shear
+        self.scale = scale
+        self.alpha = alpha
+        self.sigma = sigma
+        self.gamma_range = gamma_range
+        self.generator = torch.Generator()
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+
+    def rand(self, *shape, low=0.0, high=1.0):
+        # drawn on the CPU, so that the random stream does not depend on the device
+        return torch.rand(*shape, generator=self.generator) * (high - low) + low
+
+    def gamma(self, imgs, select):
+        """
+        Gamma transform of the images of the selected episodes
+        imgs: ... x B x C x H x W, intensity range taken per episode over all its images
+        """
+        dims = [d for d in range(imgs.dim()) if d != imgs.dim() - 4]
+        shape = [1] * imgs.dim()
+        shape[-4] = -1
+        gamma = self.rand(
+            imgs.shape[-4], low=self.gamma_range[0], high=self.gamma_range[1]
+        )
+        gamma = gamma.to(imgs.device).view(shape)
+
+        cmin = imgs.amin(dim=dims, keepdim=True)
+        irange = imgs.amax(dim=dims, keepdim=True) - cmin + 1e-5
+        out = irange * torch.pow((imgs - cmin + 1e-5) / irange, gamma) + cmin
+        return torch.where(select.view(shape), out, imgs)
+
+    def get_grid(self, n, size, device):
+        """
+        Sampling grids of n random affine + elastic transforms, n x H x W x 2
+        """
+        height, width = size
+        params = torch.stack(
+            (
+                self.rand(n, low=-self.rotate, high=self.rotate),
+                self.rand(n, low=-self.shift[0], high=self.shift[0]),
+                self.rand(n, low=-self.shift[1], high=self.shift[1]),
+                self.rand(n, low=-self.shear, high=self.shear),
+                self.rand(n, low=self.scale[0], high=self.scale[1]),
+            ),
+            dim=1,
+        ).to(device)
+        inverse = get_affine_matrices(params, size)  # n x 3 x 3
+
+        # elastic displacement in pixels, followed by the affine transform
+        disp = smooth(self.rand(n, 2, height, width, low=-1.0).to(device), self.sigma)
+        disp = disp * self.alpha
+        ys, xs = torch.meshgrid(
+            torch.arange(height, dtype=torch.float32, device=device),
+            torch.arange(width, dtype=torch.float32, device=device),
+            indexing="ij",
+        )
+        x = xs + disp[:, 1]
+        y = ys + disp[:, 0]
+        src_x = inverse[:, 0, 0, None, None] * x + inverse[:, 0, 1, None, None] * y
+        src_x = src_x + inverse[:, 0, 2, None, None]
+        src_y = inverse[:, 1, 0, None, None] * x + inverse[:, 1, 1, None, None] * y
+        src_y = src_y + inverse[:, 1, 2, None, None]
+
+        # pixel -> normalized coordinates (align_corners=True)
+        return torch.stack(
+            (2 * src_x / (width - 1) - 1, 2 * src_y / (height - 1) - 1), dim=-1
+        )
+
+    def warp(self, imgs, masks, grid):
+        """
+        imgs: K x C x H x W, masks: K x H x W, grid: K x H x W x 2
+        """
+        imgs = F.grid_sample(
+            imgs, grid, mode="bilinear", padding_mode="zeros", align_corners=True
+        )
+        masks = F.grid_sample(
+            masks[:, None].float(),
+            grid,
+            mode="nearest",
+            padding_mode="zeros",
+            align_corners=True,
+        )[:, 0].to(masks.dtype)
+        return imgs, masks
+
+    def __call__(self, batch):
+        sup_img = batch["support_images"]  # Wa x Sh x B x C x H x W
+        sup_lbl = batch["support_fg_labels"]  # Wa x Sh x B x H x W
+        qry_img = batch["query_images"]  # N x B x C x H x W
+        qry_lbl = batch["query_labels"]  # N x B x H x W
+        n_batch = qry_img.shape[1]
+        size = qry_img.shape[-2:]
+        device = qry_img.device
+
+        # gamma transform of the query or the support images of each episode
+        gamma_qry = (self.rand(n_batch) > 0.5).to(device)
+        qry_img = self.gamma(qry_img, gamma_qry)
+        sup_img = self.gamma(sup_img, ~gamma_qry)
+
+        # geometric transform of the query or the support slices of each episode
+        geom_qry = (self.rand(n_batch) > 0.5).to(device)
+        qry_sel = geom_qry.expand(qry_img.shape[0], n_batch)  # N x B
+        sup_sel = (~geom_qry).expand(*sup_img.shape[:2], n_batch)  # Wa x Sh x B
+        imgs = torch.cat((sup_img[sup_sel], qry_img[qry_sel]))  # K x C x H x W
+        masks = torch.cat((sup_lbl[sup_sel], qry_lbl[qry_sel]))  # K x H x W
+        if len(imgs):
+            imgs, masks = self.warp(imgs, masks, self.get_grid(len(imgs), size, device))
+            n_sup = int(sup_sel.sum())
+            sup_img, sup_lbl = sup_img.clone(), sup_lbl.clone()
+            qry_img, qry_lbl = qry_img.clone(), qry_lbl.clone()
+            sup_img[sup_sel], sup_lbl[sup_sel] = imgs[:n_sup], masks[:n_sup]
+            qry_img[qry_sel], qry_lbl[qry_sel] = imgs[n_sup:], masks[n_sup:]
+
+        batch = dict(batch)
+        batch["support_images"], batch["support_fg_labels"] = sup_img, sup_lbl
+        batch["query_images"], batch["query_labels"] = qry_img, qry_lbl
+        return batch
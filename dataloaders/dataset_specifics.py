@@ -3,9 +3,7 @@ Dataset Specifics
 Extended from ADNet code by Hansen et al.
 """
 
-import random
-
-import torch
+import numpy as np
 
 
 def get_label_names(dataset):
@@ -96,8 +94,22 @@ def get_folds(dataset):
         raise ValueError(f"Dataset: {dataset} not found")
 
 
-def sample_xy(spr, k=0, b=215):
-    _, h, v = torch.where(spr)
+def sample_xy(spr, k=0, b=215, rng=None):
+    """
+    Random top-left corner of a b x b crop window around the foreground of spr (D x H x W)
+    The window covers the whole foreground if it fits, up to k pixels of margin
+
+    Args:
+        spr: foreground mask, numpy array or CPU tensor
+        rng: numpy Generator, None for a freshly seeded one
+    Returns:
+        (row, column) of the top-left corner
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    spr = np.asarray(spr)
+    _, h, v = np.nonzero(spr)
+    size_h, size_v = spr.shape[-2:]
 
     if len(h) == 0 or len(v) == 0:
         horizontal = 0
@@ -107,26 +119,26 @@ def sample_xy(spr, k=0, b=215):
         h_max = max(h)
         if b > (h_max - h_min):
             kk = min(k, int((h_max - h_min) / 2))
-            horizontal = random.randint(
-                max(h_max - b - kk, 0), min(h_min + kk, 256 - b - 1)
+            horizontal = rng.integers(
+                max(h_max - b - kk, 0), min(h_min + kk, size_h - b - 1) + 1
             )
         else:
             kk = min(k, int(b / 2))
-            horizontal = random.randint(
-                max(h_min - kk, 0), min(h_max - b + kk, 256 - b - 1)
+            horizontal = rng.integers(
+                max(h_min - kk, 0), min(h_max - b + kk, size_h - b - 1) + 1
             )
 
         v_min = min(v)
         v_max = max(v)
         if b > (v_max - v_min):
             kk = min(k, int((v_max - v_min) / 2))
-            vertical = random.randint(
-                max(v_max - b - kk, 0), min(v_min + kk, 256 - b - 1)
+            vertical = rng.integers(
+                max(v_max - b - kk, 0), min(v_min + kk, size_v - b - 1) + 1
             )
         else:
             kk = min(k, int(b / 2))
-            vertical = random.randint(
-                max(v_min - kk, 0), min(v_max - b + kk, 256 - b - 1)
+            vertical = rng.integers(
+                max(v_min - kk, 0), min(v_max - b + kk, size_v - b - 1) + 1
             )
 
-    return horizontal, vertical
+    return int(horizontal), int(vertical)
@@ -3,85 +3,111 @@ Dataset for Training and Test
 Extended from ADNet code by Hansen et al.
 """
 
-import glob
+import multiprocessing as mp
 import os
 import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 import numpy as np
-import SimpleITK as sitk
 import torch
-import torchvision.transforms as deftfx
 from torch.utils.data import Dataset
 
-from utils import resize_image_scipy
-
 from . import image_transforms as myit
 from .dataset_specifics import *
+from .manifest import get_fold_volumes
+from .resampling import set_num_threads
+from .slice_index import build_episode_table, build_slice_index, get_episode_weights
+from .supervoxels import load_supervoxels
+from .volume_cache import load_volume
+from .volume_store import VolumeStore
+
+TRAIN_SHAPE = [None, 256, 256]  # training volumes keep their number of slices
 
 
 class TestDataset(Dataset):
     def __init__(self, args):
-        # reading the paths
-        if args["dataset"] == "CMR":
-            self.image_dirs = glob.glob(
-                os.path.join(args["data_dir"], "cmr_MR_normalized/image*")
-            )
-        elif args["dataset"] == "CHAOST2":
-            self.image_dirs = glob.glob(
-                os.path.join(args["data_dir"], "normalized/image*")
-            )
-        elif args["dataset"] == "SABS":
-            self.image_dirs = glob.glob(
-                os.path.join(args["data_dir"], "sabs_CT_normalized/image*")
-            )
-        elif args["dataset"] == "AMOS":
-            self.image_dirs = glob.glob(
-                os.path.join(args["data_dir"], "amos_CT_normalized/image*")
-            )
-            self.label_dirs = glob.glob(
-                os.path.join(args["data_dir"], "amos_CT_normalized/label*")
-            )
-
-        self.image_dirs = sorted(
-            self.image_dirs, key=lambda x: int(x.split("_")[-1].split(".nii.gz")[0])
+        # reading the paths of the test fold from the dataset manifest
+        self.volumes = get_fold_volumes(
+            args["data_dir"],
+            args["dataset"],
+            args["eval_fold"],
+            train=False,
+            cache_dir=args["cache_dir"],
         )
-
-        # remove test fold!
-        self.FOLD = get_folds(args["dataset"])
-        self.image_dirs = [
-            elem
-            for idx, elem in enumerate(self.image_dirs)
-            if idx in self.FOLD[args["eval_fold"]]
-        ]
+        self.image_dirs = [entry["image"] for entry in self.volumes]
 
         # split into support/query
         idx = np.arange(len(self.image_dirs))
         self.support_dir = self.image_dirs[idx[args["supp_idx"]]]
         self.image_dirs.pop(idx[args["supp_idx"]])  # remove support
         self.label = None
+        self.cache_dir = args["cache_dir"]  # memory-mapped volume cache (None: read NIfTI)
+
+        # in-memory LRU cache of resized volumes, shared by all test classes and the support
+        self.max_cache_bytes = args["test_cache_mb"] * 2**20
+        self.volume_cache = OrderedDict()  # {img_path: (img, lbl)}
+        self.cache_bytes = 0
+        self.cache_lock = threading.Lock()
 
     def __len__(self):
         return len(self.image_dirs)
 
-    def __getitem__(self, idx):
-        img_path = self.image_dirs[idx]
-        img = sitk.GetArrayFromImage(sitk.ReadImage(img_path))
-        new_shape = [31, 256, 256]
-        img = resize_image_scipy(img, new_shape)
+    def __getstate__(self):
+        # DataLoader workers (num_workers>0) start with an empty cache of their own, rebuilt
+        # at every pass over the loader, i.e. they bypass the cache shared across classes
+        state = self.__dict__.copy()
+        state["volume_cache"] = OrderedDict()
+        state["cache_bytes"] = 0
+        del state["cache_lock"]
+        return state
 
-        img = (img - img.mean()) / img.std()
-        img = np.stack(3 * [img], axis=1)
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache_lock = threading.Lock()
 
-        lbl = sitk.GetArrayFromImage(
-            sitk.ReadImage(
-                img_path.split("image_")[0] + "label_" + img_path.split("image_")[-1]
-            )
+    def read_volume(self, img_path):
+        """
+        Resized image (D x 1 x H x W) and label volume, from the LRU cache if possible
+        The returned arrays are shared with the cache and must not be modified
+        """
+        with self.cache_lock:
+            if img_path in self.volume_cache:
+                self.volume_cache.move_to_end(img_path)
+                return self.volume_cache[img_path]
+
+        img, lbl = self.load_volume(img_path)
+
+        with self.cache_lock:
+            if img_path not in self.volume_cache:
+                self.volume_cache[img_path] = (img, lbl)
+                self.cache_bytes += img.nbytes + lbl.nbytes
+            # evict least recently used volumes, keeping at least the newest one
+            while (
+                self.cache_bytes > self.max_cache_bytes and len(self.volume_cache) > 1
+            ):
+                _, (old_img, old_lbl) = self.volume_cache.popitem(last=False)
+                self.cache_bytes -= old_img.nbytes + old_lbl.nbytes
+            return self.volume_cache[img_path]
+
+    def load_volume(self, img_path):
+        new_shape = [31, 256, 256]
+        img = load_volume(img_path, new_shape, self.cache_dir)  # normalized float32
+        img = np.array(img)[:, None]  # D x 1 x H x W, grayscale encoder input
+
+        lbl = load_volume(
+            img_path.split("image_")[0] + "label_" + img_path.split("image_")[-1],
+            new_shape,
+            self.cache_dir,
+            is_label=True,
         )
-        lbl = resize_image_scipy(lbl, new_shape)
-        lbl[lbl == 200] = 1
-        lbl[lbl == 500] = 2
-        lbl[lbl == 600] = 3
-        lbl = 1 * (lbl == self.label)
+        return img, np.array(lbl)
+
+    def __getitem__(self, idx):
+        img_path = self.image_dirs[idx]
+        img, lbl = self.read_volume(img_path)
+        lbl = 1 * (lbl == self.label)  # binarized on access, the cache keeps all classes
 
         sample = {"id": img_path}
 
@@ -108,24 +134,8 @@ class TestDataset(Dataset):
         if label is None:
             raise ValueError("Need to specify label class!")
 
-        img_path = self.support_dir
-        img = sitk.GetArrayFromImage(sitk.ReadImage(img_path))
-        new_shape = [31, 256, 256]
-        img = resize_image_scipy(img, new_shape)
-
-        img = (img - img.mean()) / img.std()
-        img = np.stack(3 * [img], axis=1)
-
-        lbl = sitk.GetArrayFromImage(
-            sitk.ReadImage(
-                img_path.split("image_")[0] + "label_" + img_path.split("image_")[-1]
-            )
-        )
-        lbl = resize_image_scipy(lbl, new_shape)
-        lbl[lbl == 200] = 1
-        lbl[lbl == 500] = 2
-        lbl[lbl == 600] = 3
-        lbl = 1 * (lbl == label)
+        img, lbl = self.read_volume(self.support_dir)
+        lbl = 1 * (lbl == label)  # binarized on access, the cache keeps all classes
 
         sample = {}
         if all_slices:
@@ -144,265 +154,240 @@ class TestDataset(Dataset):
         return sample
 
 
-class TrainDataset(Dataset):
+def get_train_dirs(volumes):
+    """
+    Image and label paths of the training volumes listed in the manifest
+    """
+    image_dirs = [entry["image"] for entry in volumes]
+    label_dirs = [entry["label"] for entry in volumes]
+    return image_dirs, label_dirs
+
+
+def read_train_volume(image_dir, label_dir, cache_dir, n_sv=None, compactness=0.1):
+    """
+    Resized image and label volume, the label being the supervoxels of the image if n_sv is given
+    """
+    img = load_volume(image_dir, TRAIN_SHAPE, cache_dir)
+    if n_sv is not None:
+        lbl = load_supervoxels(image_dir, TRAIN_SHAPE, n_sv, cache_dir, compactness)
+    else:
+        lbl = load_volume(label_dir, TRAIN_SHAPE, cache_dir, True)
+    return img, lbl
+
+
+def load_into_store(images, labels, slot, *args):
+    """
+    Read a volume into slot of the volume stores, args as for read_train_volume
+    Returns its slice index (one entry per class or supervoxel)
+    """
+    images[slot], labels[slot] = read_train_volume(*args)
+    return build_slice_index(labels[slot])
+
+
+def get_displacement_bank(n_fields, path=None, sigma=5, shape=(320, 320)):
+    """
+    Bank of n_fields elastic displacement fields, loaded from path if it exists, generated
+    (and written to path) otherwise. None if n_fields is 0 (fields generated per draw)
+    Fields are larger than the 256 x 256 slices so that every draw can take a random crop
+    """
+    if not n_fields:
+        return None
+    if path is not None and os.path.exists(path):
+        bank = myit.DisplacementBank.load(path)
+        if len(bank.fields) != n_fields:
+            raise ValueError(
+                f"{path} holds {len(bank.fields)} displacement fields, not"
+                f" n_elastic_fields={n_fields}: remove it or change elastic_bank_path"
+            )
+        return bank
+    rng = np.random.default_rng(torch.initial_seed())
+    bank = myit.DisplacementBank.generate(n_fields, shape, sigma, rng)
+    if path is not None:
+        bank.save(path)
+    return bank
+
+
+class EpisodeMixin(object):
+    """
+    Episode sampling and augmentation shared by the training datasets
+    """
+
     def __init__(self, args):
         self.n_shot = args["n_shot"]
         self.n_way = args["n_way"]
         self.n_query = args["n_query"]
-        self.n_sv = args["n_sv"]
         self.max_iter = args["max_iter"]
-        self.read = True  # read images before get_item
-        self.train_sampling = "neighbors"
         self.min_size = args["min_size"]
         self.test_label = args["test_label"]
         self.exclude_label = args["exclude_label"]
         self.use_gt = args["use_gt"]
-
-        # reading the paths (leaving the reading of images into memory to __getitem__)
-        if args["dataset"] == "CMR":
-            self.image_dirs = glob.glob(
-                os.path.join(args["data_dir"], "cmr_MR_normalized/image*")
-            )
-            self.label_dirs = glob.glob(
-                os.path.join(args["data_dir"], "cmr_MR_normalized/label*")
-            )
-        elif args["dataset"] == "CHAOST2":
-            self.image_dirs = glob.glob(
-                os.path.join(args["data_dir"], "normalized/image*")
-            )
-            self.label_dirs = glob.glob(
-                os.path.join(args["data_dir"], "normalized/label*")
-            )
-        elif args["dataset"] == "SABS":
-            self.image_dirs = glob.glob(
-                os.path.join(args["data_dir"], "sabs_CT_normalized/image*")
-            )
-            self.label_dirs = glob.glob(
-                os.path.join(args["data_dir"], "sabs_CT_normalized/label*")
-            )
-
-        elif args["dataset"] == "AMOS":
-            self.image_dirs = glob.glob(
-                os.path.join(args["data_dir"], "amos_CT_normalized/image*")
-            )
-            self.label_dirs = glob.glob(
-                os.path.join(args["data_dir"], "amos_CT_normalized/label*")
+        self.episode_weighting = args["episode_weighting"]
+        self.roi_size = args["roi_size"]  # crop episodes around the foreground, None: full slices
+        self.roi_margin = args["roi_margin"]
+        slice_size = min(TRAIN_SHAPE[1:])
+        if self.roi_size is not None and not 0 < self.roi_size < slice_size - 1:
+            raise ValueError(
+                f"roi_size={self.roi_size} must be in (0, {slice_size - 1}) for"
+                f" {TRAIN_SHAPE[1]} x {TRAIN_SHAPE[2]} slices, None for full slices"
             )
-
-        self.image_dirs = sorted(
-            self.image_dirs, key=lambda x: int(x.split("_")[-1].split(".nii.gz")[0])
-        )
-        self.label_dirs = sorted(
-            self.label_dirs, key=lambda x: int(x.split("_")[-1].split(".nii.gz")[0])
-        )
-        self.sprvxl_dirs = glob.glob(
-            os.path.join(args["data_dir"], "supervoxels_" + str(args["n_sv"]), "super*")
-        )
-        self.sprvxl_dirs = sorted(
-            self.sprvxl_dirs, key=lambda x: int(x.split("_")[-1].split(".nii.gz")[0])
+        # False: episodes are augmented after collate (BatchAugment)
+        self.augment = not args["batch_augment"]
+        self.affine_elastic = myit.AffineElasticTransform(
+            myit.RandomAffine(
+                rotation_range=5,
+                translation_range=(5, 5),
+                shear_range=5,
+                zoom_range=(0.9, 1.2),
+                zoom_keep_aspect=True,
+            ),
+            alpha=10,
+            sigma=5,
+            bank=get_displacement_bank(
+                args["n_elastic_fields"], args["elastic_bank_path"], sigma=5
+            ),
         )
+        self.rng = None
+        self.rng_seed = None
 
-        # remove test fold!
-        self.FOLD = get_folds(args["dataset"])
-        self.image_dirs = [
-            elem
-            for idx, elem in enumerate(self.image_dirs)
-            if idx not in self.FOLD[args["eval_fold"]]
-        ]
-        self.label_dirs = [
-            elem
-            for idx, elem in enumerate(self.label_dirs)
-            if idx not in self.FOLD[args["eval_fold"]]
-        ]
-        self.sprvxl_dirs = [
-            elem
-            for idx, elem in enumerate(self.sprvxl_dirs)
-            if idx not in self.FOLD[args["eval_fold"]]
-        ]
-
-        # read images
-        if self.read:
-            self.images = {}
-            self.labels = {}
-            self.sprvxls = {}
-            for image_dir, label_dir in zip(self.image_dirs, self.label_dirs):
-                img = sitk.GetArrayFromImage(
-                    sitk.ReadImage(image_dir)
-                )
-                gt  = sitk.GetArrayFromImage(
-                    sitk.ReadImage(label_dir)
-                )
-                new_shape = [img.shape[0], 256, 256]
-                self.images[image_dir] = resize_image_scipy(img, new_shape)
-                self.labels[label_dir] = resize_image_scipy(gt, new_shape)
+    def get_rng(self):
+        """
+        Random generator of the current process, seeded from the torch seed: the seeded main
+        process, or a different seed in every DataLoader worker (base seed + worker id)
+        """
+        seed = torch.initial_seed()
+        if self.rng_seed != seed:  # e.g. a worker forked from a process that already had one
+            self.rng = np.random.default_rng(seed)
+            self.rng_seed = seed
+        return self.rng
 
-    def __len__(self):
-        return self.max_iter
+    def episode_rng(self):
+        """
+        Independent generator for the sampling and augmentation of one episode
+        """
+        return np.random.default_rng(self.get_rng().integers(2**63))
 
-    def gamma_tansform(self, img):
+    def gamma_tansform(self, img, rng):
         gamma_range = (0.5, 1.5)
-        gamma = np.random.rand() * (gamma_range[1] - gamma_range[0]) + gamma_range[0]
+        gamma = np.float32(
+            rng.random() * (gamma_range[1] - gamma_range[0]) + gamma_range[0]
+        )
         cmin = img.min()
-        irange = img.max() - cmin + 1e-5
+        irange = img.max() - cmin + np.float32(1e-5)
 
-        img = img - cmin + 1e-5
-        img = irange * np.power(img * 1.0 / irange, gamma)
-        img = img + cmin
+        # in place, float32 throughout
+        img = img - cmin + np.float32(1e-5)
+        img /= irange
+        np.power(img, gamma, out=img)
+        img *= irange
+        img += cmin
 
         return img
 
-    def geom_transform(self, img, mask):
-        affine = {"rotate": 5, "shift": (5, 5), "shear": 5, "scale": (0.9, 1.2)}
-        alpha = 10
-        sigma = 5
-        order = 3
+    def get_geom_transform(self, rng):
+        """
+        Random affine + elastic transform of an H x W x C array (new parameters at every call),
+        resampled once
+        """
 
-        tfx = []
-        tfx.append(
-            myit.RandomAffine(
-                affine.get("rotate"),
-                affine.get("shift"),
-                affine.get("shear"),
-                affine.get("scale"),
-                affine.get("scale_iso", True),
-                order=order,
-            )
-        )
-        tfx.append(myit.ElasticTransform(alpha, sigma))
-        transform = deftfx.Compose(tfx)
+        def transform(x):
+            return self.affine_elastic(x, rng)
+
+        return transform
+
+    def geom_transform(self, img, mask, rng):
+        transform = self.get_geom_transform(rng)
+        n_channels = img.shape[-3]
 
         if len(img.shape) > 4:
             n_shot = img.shape[1]
             for shot in range(n_shot):
-                cat = np.concatenate((img[0, shot], mask[:, shot])).transpose(1, 2, 0)
+                cat = np.concatenate(
+                    (img[0, shot], mask[:, shot].astype(img.dtype))
+                ).transpose(1, 2, 0)
                 cat = transform(cat).transpose(2, 0, 1)
-                img[0, shot] = cat[:3, :, :]
-                mask[:, shot] = np.rint(cat[3:, :, :])
+                img[0, shot] = cat[:n_channels, :, :]
+                mask[:, shot] = np.rint(cat[n_channels:, :, :])
 
         else:
             for q in range(img.shape[0]):
-                cat = np.concatenate((img[q], mask[q][None])).transpose(1, 2, 0)
+                cat = np.concatenate(
+                    (img[q], mask[q][None].astype(img.dtype))
+                ).transpose(1, 2, 0)
                 cat = transform(cat).transpose(2, 0, 1)
-                img[q] = cat[:3, :, :]
-                mask[q] = np.rint(cat[3:, :, :].squeeze())
+                img[q] = cat[:n_channels, :, :]
+                mask[q] = np.rint(cat[n_channels:, :, :].squeeze())
 
         return img, mask
 
-    def __getitem__(self, idx):
-        # sample patient idx
-        pat_idx = random.choice(range(len(self.image_dirs)))
-
-        if self.read:
-            # get image/supervoxel volume from dictionary
-            img = self.images[self.image_dirs[pat_idx]]
-            gt = self.labels[self.label_dirs[pat_idx]]
-        else:
-            # read image/supervoxel volume into memory
-            img = sitk.GetArrayFromImage(sitk.ReadImage(self.image_dirs[pat_idx]))
-            gt = sitk.GetArrayFromImage(sitk.ReadImage(self.label_dirs[pat_idx]))
-
-            new_shape = [img.shape[0], 256, 256]
-            img = resize_image_scipy(img, new_shape)
-            gt = resize_image_scipy(gt, new_shape)
-
-        exclude_idx = []
-
-        # normalize
-        img = (img - img.mean()) / img.std()
-
-        # chose training label
-        if self.use_gt:
-            lbl = gt.copy()
-
-        # sample class(es) (gt/supervoxel)
-        unique = list(np.unique(lbl))
-        for i in range(len(unique)):
-            unique[i] = int(unique[i])
-        unique.remove(0)
+    def build_episode_table(self, slice_indices):
+        """
+        Table of all valid episodes of the volumes and their sampling probabilities
+        """
+        exclude_classes = set()
         if self.use_gt:
-            unique = list(set(unique) - set(self.test_label))
-            unique = list(set(unique) - set(self.exclude_label))
-
-        size = 0
-        while size < self.min_size:
-            n_slices = (self.n_shot * self.n_way) + self.n_query - 1
-            while n_slices < ((self.n_shot * self.n_way) + self.n_query):
-                cls_idx = random.choice(unique)
-
-                # extract slices containing the sampled class
-                sli_idx = np.sum(lbl == cls_idx, axis=(1, 2)) > 0
-                idx = np.arange(lbl.shape[0])
-                sli_idx = idx[sli_idx]
-
-                sli_idx = list(
-                    set(sli_idx) - set(np.intersect1d(sli_idx, exclude_idx))
-                )  # remove slices containing test labels
-                n_slices = len(sli_idx)
-
-            # generate possible subsets with successive slices (size = self.n_shot * self.n_way + self.n_query)
-            subsets = []
-            for i in range(len(sli_idx)):
-                if not subsets:
-                    subsets.append([sli_idx[i]])
-                elif sli_idx[i - 1] + 1 == sli_idx[i]:
-                    subsets[-1].append(sli_idx[i])
-                else:
-                    subsets.append([sli_idx[i]])
-            i = 0
-            while i < len(subsets):
-                if len(subsets[i]) < (self.n_shot * self.n_way + self.n_query):
-                    del subsets[i]
-                else:
-                    i += 1
-            if not len(subsets):
-                return self.__getitem__(
-                    idx + np.random.randint(low=0, high=self.max_iter - 1, size=(1,))
-                )
-
-            # sample support and query slices
-            i = random.choice(np.arange(len(subsets)))  # subset index
-            i = random.choice(
-                subsets[i][: -(self.n_shot * self.n_way + self.n_query - 1)]
-            )
-            sample = np.arange(i, i + (self.n_shot * self.n_way) + self.n_query)
+            exclude_classes = set(self.test_label) | set(self.exclude_label or [])
+        table = build_episode_table(
+            slice_indices,
+            self.n_shot * self.n_way + self.n_query,
+            self.min_size,
+            exclude_classes,
+        )
+        return table, get_episode_weights(table, self.episode_weighting)
 
-            lbl_cls = 1 * (lbl == cls_idx)
+    def choose_episode(self, table, weights, rng):
+        """
+        Returns (volume, class, first slice) of a random episode of the table
+        """
+        return table[rng.choice(len(table), p=weights)]
 
-            size = max(np.sum(lbl_cls[sample[0]]), np.sum(lbl_cls[sample[1]]))
+    def make_episode(self, img, lbl, cls_idx, start, rng):
+        """
+        Build the support and query slices of an episode (one class, successive slices)
+        img is normalized float32 (see volume_cache), only the sampled slices are read
+        """
+        # support and query slices
+        sample = np.arange(start, start + (self.n_shot * self.n_way) + self.n_query)
 
         # invert order
-        if np.random.random(1) > 0.5:
+        if rng.random() > 0.5:
             sample = sample[::-1]  # successive slices (inverted)
 
-        sup_lbl = lbl_cls[sample[: self.n_shot * self.n_way]][
-            None,
-        ]  # n_way * (n_shot * C) * H * W
-        qry_lbl = lbl_cls[sample[self.n_shot * self.n_way :]]  # n_qry * C * H * W
+        img = np.asarray(img[sample], dtype=np.float32)  # only the sampled slices
+        lbl_cls = 1 * (lbl[sample] == cls_idx)
+
+        # ROI crop around the support/query foreground, before augmentation
+        if self.roi_size is not None:
+            top, left = sample_xy(lbl_cls, self.roi_margin, self.roi_size, rng)
+            crop = np.s_[:, top : top + self.roi_size, left : left + self.roi_size]
+            img = np.ascontiguousarray(img[crop])
+            lbl_cls = np.ascontiguousarray(lbl_cls[crop])
 
-        sup_img = img[sample[: self.n_shot * self.n_way]][
+        sup_lbl = lbl_cls[: self.n_shot * self.n_way][
             None,
         ]  # n_way * (n_shot * C) * H * W
+        qry_lbl = lbl_cls[self.n_shot * self.n_way :]  # n_qry * C * H * W
 
-        sup_img = np.stack((sup_img, sup_img, sup_img), axis=2)
-        qry_img = img[sample[self.n_shot * self.n_way :]]  # n_qry * C * H * W
-        # print(qry_img.shape)
-        qry_img = np.stack((qry_img, qry_img, qry_img), axis=1)
+        sup_img = img[: self.n_shot * self.n_way][
+            None, :, None
+        ]  # n_way * (n_shot * C) * 1 * H * W
+        qry_img = img[self.n_shot * self.n_way :][:, None]  # n_qry * 1 * H * W
         padding_mask = np.zeros_like(qry_lbl)
         s_padding_mask = np.zeros_like(sup_lbl)
-        # gamma transform
-        if np.random.random(1) > 0.5:
-            qry_img = self.gamma_tansform(qry_img)
-        else:
-            sup_img = self.gamma_tansform(sup_img)
-
-        # geom transform
-        if np.random.random(1) > 0.5:
-            qry_img, qry_lbl = self.geom_transform(qry_img, qry_lbl)
-        else:
-            (
-                sup_img,
-                sup_lbl,
-            ) = self.geom_transform(sup_img, sup_lbl)
+        if self.augment:
+            # gamma transform
+            if rng.random() > 0.5:
+                qry_img = self.gamma_tansform(qry_img, rng)
+            else:
+                sup_img = self.gamma_tansform(sup_img, rng)
+
+            # geom transform
+            if rng.random() > 0.5:
+                qry_img, qry_lbl = self.geom_transform(qry_img, qry_lbl, rng)
+            else:
+                (
+                    sup_img,
+                    sup_lbl,
+                ) = self.geom_transform(sup_img, sup_lbl, rng)
 
         sample = {
             "support_images": sup_img,
@@ -413,3 +398,186 @@ class TrainDataset(Dataset):
             "s_padding_mask": s_padding_mask,
         }
         return sample
+
+
+class TrainDataset(EpisodeMixin, Dataset):
+    def __init__(self, args):
+        super().__init__(args)
+        self.n_sv = args["n_sv"]
+        self.read = True  # read images before get_item
+        self.train_sampling = "neighbors"
+        self.cache_dir = args["cache_dir"]  # memory-mapped volume cache (None: read NIfTI)
+        self.n_load_workers = args["n_load_workers"]
+        self.resample_threads = args["resample_threads"]
+        self.window_size = args["max_volumes_in_memory"]  # None: all volumes
+        # 'random': draw episodes from the table, 'loss': indices are table rows (LossAwareSampler)
+        self.episode_sampling = args["episode_sampling"]
+        # pseudo-labels: supervoxels generated into the volume cache
+        self.sv_compactness = args["sv_compactness"]
+        self.label_n_sv = None if self.use_gt else self.n_sv
+
+        # reading the paths of the training volumes from the dataset manifest
+        self.volumes = get_fold_volumes(
+            args["data_dir"],
+            args["dataset"],
+            args["eval_fold"],
+            train=True,
+            cache_dir=args["cache_dir"],
+        )
+        self.image_dirs, self.label_dirs = get_train_dirs(self.volumes)
+
+        # read images into shared memory (attached by the workers without copying)
+        # only a window of max_volumes_in_memory volumes is held when the dataset exceeds RAM
+        self.next_window = None
+        if self.read:
+            self.window = self.sample_window()
+            self.images, self.labels, self.slice_indices = self.load_window(
+                self.window
+            )
+            self.episodes, self.episode_weights = self.build_episode_table(
+                self.slice_indices
+            )
+            if not len(self.episodes):
+                raise ValueError("No class has enough successive slices for an episode")
+
+    def __getstate__(self):
+        # the pending background load stays in the main process
+        state = self.__dict__.copy()
+        state["next_window"] = None
+        return state
+
+    def read_volume(self, image_dir, label_dir):
+        return read_train_volume(
+            image_dir,
+            label_dir,
+            self.cache_dir,
+            self.label_n_sv,
+            self.sv_compactness,
+        )
+
+    def sample_window(self):
+        n_volumes = len(self.image_dirs)
+        if self.window_size is None or self.window_size >= n_volumes:
+            return list(range(n_volumes))
+        return sorted(random.sample(range(n_volumes), self.window_size))
+
+    def load_window(self, pat_idxs):
+        """
+        Read and resize volumes into new volume stores, in parallel over n_load_workers processes
+        Slot i of the stores holds volume pat_idxs[i], slice_indices[i] is its slice index
+        """
+        n_slices = [self.volumes[pat_idx]["shape"][0] for pat_idx in pat_idxs]
+        images = VolumeStore(n_slices, dtype=np.float32)
+        labels = VolumeStore(n_slices, dtype=np.uint8 if self.use_gt else np.uint16)
+        slice_indices = [None] * len(pat_idxs)
+
+        if self.n_load_workers <= 1:
+            for slot, pat_idx in enumerate(pat_idxs):
+                slice_indices[slot] = load_into_store(
+                    images,
+                    labels,
+                    slot,
+                    self.image_dirs[pat_idx],
+                    self.label_dirs[pat_idx],
+                    self.cache_dir,
+                    self.label_n_sv,
+                    self.sv_compactness,
+                )
+            return images, labels, slice_indices
+
+        # spawn, as the next window is loaded from a background thread
+        # each process resizes on resample_threads threads (set once, as the setting is global)
+        with ProcessPoolExecutor(
+            max_workers=self.n_load_workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=set_num_threads,
+            initargs=(self.resample_threads,),
+        ) as pool:
+            jobs = {
+                pool.submit(
+                    load_into_store,
+                    images,
+                    labels,
+                    slot,
+                    self.image_dirs[pat_idx],
+                    self.label_dirs[pat_idx],
+                    self.cache_dir,
+                    self.label_n_sv,
+                    self.sv_compactness,
+                ): slot
+                for slot, pat_idx in enumerate(pat_idxs)
+            }
+            for n_done, job in enumerate(as_completed(jobs), 1):
+                slice_indices[jobs[job]] = job.result()
+                print(f"\rLoaded {n_done}/{len(jobs)} volumes", end="", flush=True)
+            print()
+        return images, labels, slice_indices
+
+    def prefetch_window(self):
+        """
+        Start loading the next random window of volumes in the background
+        """
+        if not self.read or len(self.window) == len(self.image_dirs):
+            return
+        window = self.sample_window()
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.next_window = (window, executor.submit(self.load_window, window))
+        executor.shutdown(wait=False)
+
+    def swap_window(self):
+        """
+        Replace the volumes in memory by the prefetched window (at a sub-epoch boundary)
+        """
+        if self.next_window is None:
+            return
+        window, job = self.next_window
+        images, labels, slice_indices = job.result()
+        self.next_window = None
+        episodes, episode_weights = self.build_episode_table(slice_indices)
+        if not len(episodes):
+            images.close()
+            labels.close()
+            raise ValueError(
+                f"No class of the {len(window)} volumes in memory has enough successive"
+                " slices for an episode, raise max_volumes_in_memory"
+            )
+        self.images.close()
+        self.labels.close()
+        self.window, self.images, self.labels = window, images, labels
+        self.slice_indices = slice_indices
+        self.episodes, self.episode_weights = episodes, episode_weights
+
+    def __len__(self):
+        return self.max_iter
+
+    def __getitem__(self, idx):
+        rng = self.episode_rng()
+        if self.read:
+            # sample an episode (volume in memory, class, first slice) from the episode table
+            if self.episode_sampling == "loss":
+                slot, cls_idx, start = self.episodes[idx]
+            else:
+                slot, cls_idx, start = self.choose_episode(
+                    self.episodes, self.episode_weights, rng
+                )
+
+            # get image/supervoxel volume from the volume store
+            pat_idx = self.window[slot]
+            img = self.images[slot]
+            lbl = self.labels[slot]
+        else:
+            episodes = []
+            while not len(episodes):  # resample the volume if it has no valid episode
+                # sample patient idx
+                pat_idx = rng.integers(len(self.image_dirs))
+
+                # read image/supervoxel volume into memory
+                img, lbl = self.read_volume(
+                    self.image_dirs[pat_idx], self.label_dirs[pat_idx]
+                )
+                episodes, weights = self.build_episode_table([build_slice_index(lbl)])
+            _, cls_idx, start = self.choose_episode(episodes, weights, rng)
+
+        sample = self.make_episode(img, lbl, cls_idx, start, rng)
+        sample["episode_ids"] = np.array([pat_idx, cls_idx])  # (volume, class)
+        return sample
@@ -0,0 +1,100 @@
+"""
+Episode Bank
+Training episodes generated ahead of time and replayed from disk, fully augmented unless they
+were written with batch_augment (augmentation of the collated batches while training)
+"""
+
+import json
+import os
+
+import numpy as np
+from torch.utils.data import DataLoader, Dataset, Sampler
+
+# stored arrays and their on-disk data types, padding masks are all zeros and not stored
+BANK_KEYS = {
+    "support_images": np.float16,
+    "support_fg_labels": np.uint8,
+    "query_images": np.float16,
+    "query_labels": np.uint8,
+}
+
+
+def write_episode_bank(dataset, n_episodes, bank_dir, num_workers=0):
+    """
+    Draw n_episodes from a (map-style) training dataset and store them as one .npy file per key
+    bank.json records whether the episodes were augmented by the dataset
+    """
+    os.makedirs(bank_dir, exist_ok=True)
+    loader = DataLoader(
+        dataset, batch_size=None, sampler=range(n_episodes), num_workers=num_workers
+    )
+
+    arrays = {}
+    for i, sample in enumerate(loader):
+        if not arrays:
+            for key, dtype in BANK_KEYS.items():
+                arrays[key] = np.lib.format.open_memmap(
+                    os.path.join(bank_dir, f"{key}.npy"),
+                    mode="w+",
+                    dtype=dtype,
+                    shape=(n_episodes,) + tuple(sample[key].shape),
+                )
+        for key in BANK_KEYS:
+            arrays[key][i] = sample[key].numpy()
+
+    for array in arrays.values():
+        array.flush()
+    with open(os.path.join(bank_dir, "bank.json"), "w") as f:
+        json.dump({"n_episodes": n_episodes, "augmented": dataset.augment}, f)
+
+
+class BankDataset(Dataset):
+    """
+    Replays the episodes of an episode bank, episode idx % n_episodes for index idx
+    """
+
+    def __init__(self, args):
+        self.bank_dir = args["episode_bank"]
+        self.max_iter = args["max_iter"]
+        with open(os.path.join(self.bank_dir, "bank.json")) as f:
+            meta = json.load(f)
+        self.n_episodes = meta["n_episodes"]
+        self.augmented = meta.get("augmented", True)  # older banks were always augmented
+        self.arrays = {
+            key: np.load(os.path.join(self.bank_dir, f"{key}.npy"), mmap_mode="r")
+            for key in BANK_KEYS
+        }
+
+    def __len__(self):
+        return self.max_iter
+
+    def __getitem__(self, idx):
+        idx = idx % self.n_episodes
+        sample = {
+            key: np.array(array[idx], dtype=np.float32)
+            if array.dtype == np.float16
+            else np.array(array[idx])
+            for key, array in self.arrays.items()
+        }
+        sample["padding_mask"] = np.zeros_like(sample["query_labels"])
+        sample["s_padding_mask"] = np.zeros_like(sample["support_fg_labels"])
+        return sample
+
+
+class ReplaySampler(Sampler):
+    """
+    Yields the next n_per_epoch consecutive indices on every pass, so that successive epochs
+    replay successive episodes of the bank in a fixed order
+    """
+
+    def __init__(self, n_per_epoch):
+        self.n_per_epoch = n_per_epoch
+        self.epoch = 0
+
+    def __len__(self):
+        return self.n_per_epoch
+
+    def __iter__(self):
+        start = self.epoch * self.n_per_epoch
+        self.epoch += 1
+        return iter(range(start, start + self.n_per_epoch))
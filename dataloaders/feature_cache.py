@@ -0,0 +1,164 @@
+"""
+Feature Cache
+Encoder features of every training slice, computed once with a frozen encoder and stored in fp16,
+so that only the CMAT head is trained
+"""
+
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from .datasets import EpisodeMixin
+from .slice_index import build_slice_index, make_class_entry
+
+FEATURE_INDEX = "features.json"
+
+
+def augment_volume(augmenter, img, lbl, rng):
+    """
+    Gamma and geometric augmentation of every slice of a volume
+    Labels are warped as one-hot channels and recovered with an argmax, so that interpolation
+    never mixes class indices
+    """
+    classes = np.unique(lbl)
+    onehot = (lbl[:, None] == classes[None, :, None, None]).astype(np.float32)
+    img = augmenter.gamma_tansform(np.array(img, dtype=np.float32), rng)
+    cat = np.concatenate((img[:, None], onehot), axis=1)  # D x (1 + K) x H x W
+    for d in range(len(cat)):
+        transform = augmenter.get_geom_transform(rng)
+        cat[d] = transform(cat[d].transpose(1, 2, 0)).transpose(2, 0, 1)
+    return cat[:, 0], classes[cat[:, 1:].argmax(axis=1)].astype(np.uint8)
+
+
+def encode_volume(encoder, img, device, batch_size=16):
+    """
+    Encoder features of the slices of a normalized volume, D x C x H' x W' in fp16
+    """
+    fts = []
+    with torch.no_grad():
+        for i in range(0, len(img), batch_size):
+            x = torch.from_numpy(np.ascontiguousarray(img[i : i + batch_size, None]))
+            fts.append(encoder(x.float().to(device), low_level=False).half().cpu())
+    return torch.cat(fts).numpy()
+
+
+def write_feature_cache(
+    encoder,
+    augmenter,
+    read_volume,
+    image_dirs,
+    label_dirs,
+    feature_dir,
+    n_augment=0,
+    seed=0,
+    device="cpu",
+    batch_size=16,
+):
+    """
+    Encode every slice of the training volumes, as is and under n_augment fixed augmentations
+    Each (volume, augmentation) pair is stored as {name}_aug{k}_features.npy (fp16) and
+    {name}_aug{k}_labels.npy (uint8), and listed with its slice index in features.json
+
+    Args:
+        encoder: frozen encoder, in eval mode on device
+        augmenter: EpisodeMixin providing the augmentations
+        read_volume: function (image_dir, label_dir) -> (normalized image, label volume)
+    """
+    os.makedirs(feature_dir, exist_ok=True)
+    entries = []
+    for vol, (image_dir, label_dir) in enumerate(zip(image_dirs, label_dirs)):
+        name = os.path.basename(image_dir).split(".nii")[0]
+        img, lbl = read_volume(image_dir, label_dir)
+        for aug in range(n_augment + 1):
+            if aug == 0:
+                aug_img, aug_lbl = img, np.asarray(lbl, dtype=np.uint8)
+            else:
+                # fixed augmentation, the same for a given seed, volume and augmentation
+                rng = np.random.default_rng([seed, vol, aug])
+                aug_img, aug_lbl = augment_volume(augmenter, img, lbl, rng)
+
+            prefix = f"{name}_aug{aug}"
+            np.save(
+                os.path.join(feature_dir, f"{prefix}_features.npy"),
+                encode_volume(encoder, aug_img, device, batch_size),
+            )
+            np.save(os.path.join(feature_dir, f"{prefix}_labels.npy"), aug_lbl)
+            entries.append(
+                {
+                    "name": prefix,
+                    "volume": vol,
+                    "augmentation": aug,
+                    "slice_index": {
+                        str(cls): {
+                            "slices": entry["slices"].tolist(),
+                            "area": entry["area"].tolist(),
+                        }
+                        for cls, entry in build_slice_index(aug_lbl).items()
+                    },
+                }
+            )
+            print(f"\rEncoded {len(entries)} volumes", end="", flush=True)
+    print()
+
+    with open(os.path.join(feature_dir, FEATURE_INDEX), "w") as f:
+        json.dump({"n_augment": n_augment, "entries": entries}, f)
+
+
+class FeatureDataset(EpisodeMixin, Dataset):
+    """
+    Training episodes made of precomputed encoder features instead of images
+    Augmentation is limited to the fixed augmentations stored in the cache
+    """
+
+    def __init__(self, args):
+        super().__init__(args)
+        if not self.use_gt:
+            raise ValueError("Feature caches hold ground truth labels, set use_gt=True")
+        self.feature_dir = args["feature_cache"]
+        with open(os.path.join(self.feature_dir, FEATURE_INDEX)) as f:
+            self.entries = json.load(f)["entries"]
+
+        self.features = []
+        self.labels = []
+        slice_indices = []
+        for entry in self.entries:
+            prefix = os.path.join(self.feature_dir, entry["name"])
+            self.features.append(np.load(f"{prefix}_features.npy", mmap_mode="r"))
+            self.labels.append(np.load(f"{prefix}_labels.npy", mmap_mode="r"))
+            slice_indices.append(
+                {
+                    int(cls): make_class_entry(index["slices"], index["area"])
+                    for cls, index in entry["slice_index"].items()
+                }
+            )
+        self.episodes, self.episode_weights = self.build_episode_table(slice_indices)
+        if not len(self.episodes):
+            raise ValueError("No class has enough successive slices for an episode")
+
+    def __len__(self):
+        return self.max_iter
+
+    def __getitem__(self, idx):
+        rng = self.episode_rng()
+        vol, cls_idx, start = self.choose_episode(
+            self.episodes, self.episode_weights, rng
+        )
+        fts = self.features[vol]
+        lbl = self.labels[vol]
+
+        # support and query slices
+        n_support = self.n_shot * self.n_way
+        sample = np.arange(start, start + n_support + self.n_query)
+        if rng.random() > 0.5:
+            sample = sample[::-1]  # successive slices (inverted)
+
+        lbl_cls = 1 * (lbl[sample] == cls_idx)
+        return {
+            "support_features": fts[sample[:n_support]][None],  # Wa x Sh x C x H' x W'
+            "support_fg_labels": lbl_cls[:n_support][None],  # Wa x Sh x H x W
+            "query_features": fts[sample[n_support:]],  # N x C x H' x W'
+            "query_labels": lbl_cls[n_support:],  # N x H x W
+        }
@@ -4,6 +4,7 @@ Code originally from Ouyang et al. (used in the 2D setting)
 """
 
 from collections.abc import Sequence
+from functools import lru_cache
 
 import cv2
 import numpy as np
@@ -11,6 +12,8 @@ from numpy.lib.stride_tricks import as_strided
 from scipy.ndimage.filters import gaussian_filter
 from scipy.ndimage.interpolation import map_coordinates
 
+from .volume_cache import atomic_save
+
 
 ###### UTILITIES ######
 def random_num_generator(config, random_state=np.random):
@@ -124,29 +127,29 @@ class RandomAffine(object):
         self.interp = interp
         self.order = order
 
-    def build_M(self, input_shape):
+    def build_M(self, input_shape, random_state=np.random):
         tfx = []
         final_tfx = np.eye(3)
         if self.rotation_range:
-            rot = np.random.uniform(-self.rotation_range, self.rotation_range)
+            rot = random_state.uniform(-self.rotation_range, self.rotation_range)
             tfx.append(get_rotation_matrix(rot, input_shape))
         if self.translation_range:
-            tx = np.random.uniform(
+            tx = random_state.uniform(
                 -self.translation_range[0], self.translation_range[0]
             )
-            ty = np.random.uniform(
+            ty = random_state.uniform(
                 -self.translation_range[1], self.translation_range[1]
             )
             tfx.append(get_translation_matrix((tx, ty)))
         if self.shear_range:
-            rot = np.random.uniform(-self.shear_range, self.shear_range)
+            rot = random_state.uniform(-self.shear_range, self.shear_range)
             tfx.append(get_shear_matrix(rot))
         if self.zoom_range:
-            sx = np.random.uniform(self.zoom_range[0], self.zoom_range[1])
+            sx = random_state.uniform(self.zoom_range[0], self.zoom_range[1])
             if self.zoom_keep_aspect:
                 sy = sx
             else:
-                sy = np.random.uniform(self.zoom_range[0], self.zoom_range[1])
+                sy = random_state.uniform(self.zoom_range[0], self.zoom_range[1])
 
             tfx.append(get_zoom_matrix((sx, sy), input_shape))
 
@@ -155,10 +158,10 @@ class RandomAffine(object):
 
         return final_tfx.astype(np.float32)
 
-    def __call__(self, image):
+    def __call__(self, image, random_state=np.random):
         # build matrix
         input_shape = image.shape[:2]
-        M = self.build_M(input_shape)
+        M = self.build_M(input_shape, random_state)
 
         res = np.zeros_like(image)
         # if isinstance(self.interp, Sequence):
@@ -214,13 +217,13 @@ def elastic_transform(
 
     dx = (
         gaussian_filter(
-            (random_state.rand(*shape) * 2 - 1), sigma, mode="constant", cval=0
+            (random_state.random(shape) * 2 - 1), sigma, mode="constant", cval=0
         )
         * alpha
     )
     dy = (
         gaussian_filter(
-            (random_state.rand(*shape) * 2 - 1), sigma, mode="constant", cval=0
+            (random_state.random(shape) * 2 - 1), sigma, mode="constant", cval=0
         )
         * alpha
     )
@@ -253,7 +256,7 @@ def elastic_transform_nd(image, alpha, sigma, random_state=None, order=1, lazy=F
     """
 
     if random_state is None:
-        random_state = np.random.RandomState(None)
+        random_state = np.random.default_rng()
 
     shape = image.shape
     imsize = shape[:2]
@@ -263,7 +266,7 @@ def elastic_transform_nd(image, alpha, sigma, random_state=None, order=1, lazy=F
     blur_size = int(4 * sigma) | 1
     dx = (
         cv2.GaussianBlur(
-            random_state.rand(*imsize) * 2 - 1,
+            random_state.random(imsize) * 2 - 1,
             ksize=(blur_size, blur_size),
             sigmaX=sigma,
         )
@@ -271,7 +274,7 @@ def elastic_transform_nd(image, alpha, sigma, random_state=None, order=1, lazy=F
     )
     dy = (
         cv2.GaussianBlur(
-            random_state.rand(*imsize) * 2 - 1,
+            random_state.random(imsize) * 2 - 1,
             ksize=(blur_size, blur_size),
             sigmaX=sigma,
         )
@@ -313,16 +316,160 @@ class ElasticTransform(object):
         self.sigma = sigma
         self.order = order
 
-    def __call__(self, image):
+    def __call__(self, image, random_state=None):
+        """
+        random_state: numpy Generator or RandomState, None for a freshly seeded one
+        """
+        if random_state is None:
+            random_state = np.random.default_rng()
         if isinstance(self.alpha, Sequence):
-            alpha = random_num_generator(self.alpha)
+            alpha = random_num_generator(self.alpha, random_state)
         else:
             alpha = self.alpha
         if isinstance(self.sigma, Sequence):
-            sigma = random_num_generator(self.sigma)
+            sigma = random_num_generator(self.sigma, random_state)
         else:
             sigma = self.sigma
-        return elastic_transform_nd(image, alpha=alpha, sigma=sigma, order=self.order)
+        return elastic_transform_nd(
+            image, alpha=alpha, sigma=sigma, random_state=random_state, order=self.order
+        )
+
+
+###### FUSED AFFINE + ELASTIC TRANSFORM ######
+@lru_cache(maxsize=8)
+def get_base_grid(shape):
+    """
+    Pixel coordinates (x: column, y: row) of an H x W image, cached per shape (read-only)
+    """
+    ys, xs = np.meshgrid(
+        np.arange(shape[0], dtype=np.float32),
+        np.arange(shape[1], dtype=np.float32),
+        indexing="ij",
+    )
+    xs.flags.writeable = False
+    ys.flags.writeable = False
+    return xs, ys
+
+
+def get_elastic_displacement(shape, alpha, sigma, random_state):
+    """
+    Smoothed random displacement (dx: columns, dy: rows) in pixels, as in elastic_transform_nd
+    """
+    blur_size = int(4 * sigma) | 1
+    dx, dy = (
+        cv2.GaussianBlur(
+            (random_state.random(shape) * 2 - 1).astype(np.float32),
+            ksize=(blur_size, blur_size),
+            sigmaX=sigma,
+        )
+        * alpha
+        for _ in range(2)
+    )
+    return dx, dy
+
+
+class DisplacementBank(object):
+    """
+    Precomputed smoothed displacement fields of unit amplitude (n x 2 x H x W, float32)
+    Every draw takes a random field, crop offset, flips, component swap, signs and amplitude
+    scale, so that a small bank yields many distinct fields without noise generation or blurring
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    @classmethod
+    def generate(cls, n_fields, shape, sigma, random_state=np.random):
+        fields = np.stack(
+            [
+                np.stack(get_elastic_displacement(shape, 1.0, sigma, random_state))
+                for _ in range(n_fields)
+            ]
+        )
+        return cls(fields)
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(path))
+
+    def save(self, path):
+        atomic_save(path, lambda f: np.save(f, self.fields))
+
+    def draw(self, shape, alpha, random_state=np.random, scale_range=(0.75, 1.25)):
+        """
+        Returns a displacement (dx, dy) in pixels for an image of the given shape
+        """
+        n, _, h, w = self.fields.shape
+        if shape[0] > h or shape[1] > w:
+            raise ValueError(f"Displacement bank fields {h}x{w} smaller than {shape}")
+
+        def randint(high):  # numpy Generator or RandomState / np.random
+            return int(random_state.random() * high)
+
+        top = randint(h - shape[0] + 1)
+        left = randint(w - shape[1] + 1)
+        field = self.fields[randint(n), :, top : top + shape[0], left : left + shape[1]]
+        if random_state.random() > 0.5:
+            field = field[:, ::-1]
+        if random_state.random() > 0.5:
+            field = field[:, :, ::-1]
+        if random_state.random() > 0.5:
+            field = field[::-1]  # swap the row and column displacements
+
+        scale = alpha * (
+            scale_range[0] + random_state.random() * (scale_range[1] - scale_range[0])
+        )
+        sign_x = 1 if random_state.random() > 0.5 else -1
+        sign_y = 1 if random_state.random() > 0.5 else -1
+        return field[0] * (sign_x * scale), field[1] * (sign_y * scale)
+
+
+class AffineElasticTransform(object):
+    """
+    RandomAffine followed by ElasticTransform on a numpy.ndarray (H x W x C), with the two
+    coordinate maps composed and applied in a single cv2.remap (bilinear)
+    The same transform is applied to all C channels
+    Elastic displacements are drawn from a DisplacementBank if one is given
+    """
+
+    def __init__(self, random_affine, alpha, sigma, bank=None):
+        self.random_affine = random_affine
+        self.alpha = alpha
+        self.sigma = sigma
+        self.bank = bank
+
+    def get_maps(self, shape, random_state):
+        M = self.random_affine.build_M(shape, random_state)
+        M_inv = np.linalg.inv(M).astype(np.float32)  # output pixel -> input pixel
+
+        # elastic displacement of the output coordinates, then the inverse affine transform
+        xs, ys = get_base_grid(shape)
+        if self.bank is not None:
+            dx, dy = self.bank.draw(shape, self.alpha, random_state)
+        else:
+            dx, dy = get_elastic_displacement(
+                shape, self.alpha, self.sigma, random_state
+            )
+        x = xs + dx
+        y = ys + dy
+        map_x = M_inv[0, 0] * x + M_inv[0, 1] * y + M_inv[0, 2]
+        map_y = M_inv[1, 0] * x + M_inv[1, 1] * y + M_inv[1, 2]
+        return map_x, map_y
+
+    def __call__(self, image, random_state=np.random):
+        shape = image.shape[:2]
+        map_x, map_y = self.get_maps(shape, random_state)
+        image = image.reshape(shape + (-1,))
+        res = np.empty_like(image)
+        for c in range(0, image.shape[2], 4):  # cv2.remap takes up to 4 channels
+            res[..., c : c + 4] = cv2.remap(
+                np.ascontiguousarray(image[..., c : c + 4]),
+                map_x,
+                map_y,
+                interpolation=cv2.INTER_LINEAR,
+                borderMode=cv2.BORDER_CONSTANT,
+            ).reshape(shape + (-1,))
+        return res
 
 
 class RandomFlip3D(object):
@@ -0,0 +1,102 @@
+"""
+Loss-Aware Sampler
+Importance sampling of training episodes from the running loss of each (volume, class) pair
+"""
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class LossAwareSampler(Sampler):
+    """
+    Samples rows of the episode table of a TrainDataset (episode_sampling='loss')
+
+    A (volume, class) group is drawn with probability
+        (1 - floor) * loss ** (1 / temperature) / sum(...) + floor * (its base probability)
+    where loss is a running average of the episode losses reported by update(), and the base
+    probability is that of the dataset's episode_weighting. Episodes within a group follow the
+    base weights. Groups without a loss yet get the highest loss of the current groups (of all
+    groups if none has one yet), so every group is tried
+    Probabilities are recomputed after every update(), so that losses fed back during an epoch
+    are used by the next draws (up to the episodes already prefetched by the DataLoader)
+    """
+
+    def __init__(self, dataset, n_samples, temperature=1.0, floor=0.2, momentum=0.9):
+        self.dataset = dataset
+        self.n_samples = n_samples
+        self.temperature = temperature
+        self.floor = floor
+        self.momentum = momentum
+        self.losses = {}  # {(volume, class): running loss}, kept across volume windows
+        self.group_index = {}  # {(volume, class): group} of the current episode table
+        self.scores = np.zeros(0)  # running loss of each current group, nan if unknown
+        self.cdf = None  # cumulative group probabilities, None after an update
+        self.rng = np.random.default_rng(torch.initial_seed())
+
+    def __len__(self):
+        return self.n_samples
+
+    def update(self, episode_ids, losses):
+        """
+        Args:
+            episode_ids: B x 2 array of (volume, class), the episode_ids of a batch
+            losses: B losses of these episodes
+        """
+        for (vol, cls), loss in zip(np.asarray(episode_ids), np.asarray(losses)):
+            key = (int(vol), int(cls))
+            if key in self.losses:
+                loss = self.momentum * self.losses[key] + (1 - self.momentum) * loss
+            self.losses[key] = float(loss)
+            group = self.group_index.get(key)
+            if group is not None:
+                self.scores[group] = self.losses[key]
+        self.cdf = None
+
+    def get_groups(self):
+        """
+        (volume, class) groups of the current episode table, with their rows and base weights
+        """
+        table = self.dataset.episodes
+        weights = self.dataset.episode_weights
+        vols = np.asarray(self.dataset.window)[table[:, 0]]
+        keys, inverse = np.unique(
+            np.stack((vols, table[:, 1]), axis=1), axis=0, return_inverse=True
+        )
+        inverse = inverse.reshape(-1)
+        counts = np.bincount(inverse, minlength=len(keys))
+        rows = np.split(np.argsort(inverse, kind="stable"), np.cumsum(counts)[:-1])
+        base = np.bincount(inverse, weights=weights, minlength=len(keys))
+        return [tuple(key) for key in keys.tolist()], rows, base
+
+    def get_group_cdf(self, base):
+        if self.cdf is None:
+            probs = base
+            if self.losses:
+                known = ~np.isnan(self.scores)
+                if known.any():
+                    default = self.scores[known].max()
+                else:
+                    default = max(self.losses.values())
+                scores = np.where(np.isnan(self.scores), default, self.scores)
+                scores = np.maximum(scores, 1e-8) ** (1.0 / self.temperature)
+                probs = (1 - self.floor) * scores / scores.sum() + self.floor * base
+            self.cdf = np.cumsum(probs)
+        return self.cdf
+
+    def __iter__(self):
+        keys, rows, base = self.get_groups()
+        weights = self.dataset.episode_weights
+        self.group_index = {key: group for group, key in enumerate(keys)}
+        self.scores = np.array([self.losses.get(key, np.nan) for key in keys])
+        self.cdf = None
+        for _ in range(self.n_samples):
+            cdf = self.get_group_cdf(base)
+            group = min(
+                int(np.searchsorted(cdf, self.rng.random() * cdf[-1], side="right")),
+                len(keys) - 1,
+            )
+            group_rows = rows[group]
+            yield int(
+                self.rng.choice(group_rows, p=weights[group_rows] / base[group])
+            )
@@ -0,0 +1,201 @@
+"""
+Dataset Manifest
+Generated once per dataset directory: path pairs, shape, spacing, intensity statistics,
+present classes and fold membership of every volume
+"""
+
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+import SimpleITK as sitk
+
+from .dataset_specifics import get_folds
+from .volume_cache import atomic_save
+
+MANIFEST_NAME = "manifest.json"
+
+IMAGE_PATTERNS = {
+    "CMR": "cmr_MR_normalized/image*",
+    "CHAOST2": "normalized/image*",
+    "SABS": "sabs_CT_normalized/image*",
+    "AMOS": "amos_CT_normalized/image*",
+}
+
+
+def get_volume_id(path):
+    return int(path.split("_")[-1].split(".nii.gz")[0])
+
+
+def get_mtime(data_dir, path):
+    if path is None:
+        return None
+    return os.stat(os.path.join(data_dir, path)).st_mtime_ns
+
+
+def scan_volumes(data_dir, dataset):
+    """
+    Image/label paths (relative to data_dir), sorted by volume id
+    """
+    image_dirs = sorted(
+        glob.glob(os.path.join(data_dir, IMAGE_PATTERNS[dataset])), key=get_volume_id
+    )
+
+    volumes = []
+    for image_dir in image_dirs:
+        label_dir = (
+            image_dir.split("image_")[0] + "label_" + image_dir.split("image_")[-1]
+        )
+        volumes.append(
+            {
+                "id": get_volume_id(image_dir),
+                "image": os.path.relpath(image_dir, data_dir),
+                "label": os.path.relpath(label_dir, data_dir)
+                if os.path.exists(label_dir)
+                else None,
+            }
+        )
+    return volumes
+
+
+def describe_volume(data_dir, entry):
+    """
+    Read a volume once and record its header information and statistics
+    """
+    img_obj = sitk.ReadImage(os.path.join(data_dir, entry["image"]))
+    img = sitk.GetArrayFromImage(img_obj)
+    entry["mtime"] = {
+        "image": get_mtime(data_dir, entry["image"]),
+        "label": get_mtime(data_dir, entry["label"]),
+    }
+    entry["shape"] = list(img.shape)
+    entry["spacing"] = list(img_obj.GetSpacing())
+    entry["intensity"] = {
+        "mean": float(img.mean()),
+        "std": float(img.std()),
+        "min": float(img.min()),
+        "max": float(img.max()),
+    }
+    if entry["label"] is not None:
+        lbl = sitk.GetArrayFromImage(
+            sitk.ReadImage(os.path.join(data_dir, entry["label"]))
+        )
+        entry["classes"] = [int(cls) for cls in np.unique(lbl) if cls != 0]
+    else:
+        entry["classes"] = []
+    return entry
+
+
+def is_stale(data_dir, entry):
+    try:
+        return entry["mtime"] != {
+            "image": get_mtime(data_dir, entry["image"]),
+            "label": get_mtime(data_dir, entry["label"]),
+        }
+    except FileNotFoundError:
+        return True
+
+
+def get_manifest_paths(data_dir, dataset, cache_dir=None):
+    """
+    Manifest locations, by preference: data_dir, then cache_dir (for read-only data_dir)
+    """
+    paths = [os.path.join(data_dir, MANIFEST_NAME)]
+    if cache_dir is not None:
+        key = hashlib.sha1(os.path.abspath(data_dir).encode()).hexdigest()[:16]
+        paths.append(os.path.join(cache_dir, f"manifest_{dataset}_{key}.json"))
+    return paths
+
+
+def write_manifest(manifest, data_dir, cache_dir=None):
+    """
+    Write the manifest to data_dir, or to cache_dir if data_dir is not writable
+    """
+    for path in get_manifest_paths(data_dir, manifest["dataset"], cache_dir):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        if not os.access(directory, os.W_OK):
+            continue
+        atomic_save(path, lambda f: json.dump(manifest, f, indent=1), mode="w")
+        return
+    print(f"Warning: no writable location for the manifest of {data_dir}, set cache_dir")
+
+
+def build_manifest(data_dir, dataset, old_manifest=None, cache_dir=None):
+    """
+    Scan data_dir and describe every volume, reusing up-to-date entries of old_manifest
+    """
+    old_entries = {}
+    if old_manifest is not None:
+        old_entries = {entry["image"]: entry for entry in old_manifest["volumes"]}
+
+    FOLD = get_folds(dataset)
+    volumes = []
+    for idx, entry in enumerate(scan_volumes(data_dir, dataset)):
+        old_entry = old_entries.get(entry["image"])
+        if (
+            old_entry is not None
+            and old_entry["label"] == entry["label"]
+            and not is_stale(data_dir, old_entry)
+        ):
+            entry = dict(old_entry)
+            entry.pop("supervoxels", None)  # listed by older manifests
+        else:
+            entry = describe_volume(data_dir, entry)
+        entry["folds"] = [fold for fold, fold_idx in FOLD.items() if idx in fold_idx]
+        volumes.append(entry)
+
+    manifest = {
+        "dataset": dataset,
+        "dir_mtime": get_dir_mtimes(data_dir, dataset),
+        "volumes": volumes,
+    }
+    write_manifest(manifest, data_dir, cache_dir)
+    return manifest
+
+
+def get_dir_mtimes(data_dir, dataset):
+    """
+    Modification times of the volume directories (changed by adding or removing files)
+    """
+    dirs = [os.path.dirname(os.path.join(data_dir, IMAGE_PATTERNS[dataset]))]
+    return {os.path.relpath(d, data_dir): os.stat(d).st_mtime_ns for d in dirs}
+
+
+def load_manifest(data_dir, dataset, cache_dir=None):
+    """
+    Load the manifest of data_dir, (re)building it if it is missing or stale
+    """
+    old_manifest = None
+    for manifest_path in get_manifest_paths(data_dir, dataset, cache_dir):
+        if not os.path.exists(manifest_path):
+            continue
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if (
+            manifest["dataset"] == dataset
+            and manifest["dir_mtime"] == get_dir_mtimes(data_dir, dataset)
+            and not any(is_stale(data_dir, entry) for entry in manifest["volumes"])
+        ):
+            return manifest
+        if old_manifest is None:
+            old_manifest = manifest
+    return build_manifest(data_dir, dataset, old_manifest, cache_dir)
+
+
+def get_fold_volumes(data_dir, dataset, eval_fold, train, cache_dir=None):
+    """
+    Manifest entries of the training volumes (train=True) or of the test fold, paths made absolute
+    """
+    volumes = []
+    for entry in load_manifest(data_dir, dataset, cache_dir)["volumes"]:
+        if (eval_fold in entry["folds"]) == train:
+            continue
+        entry = dict(entry)
+        for key in ["image", "label"]:
+            if entry[key] is not None:
+                entry[key] = os.path.join(data_dir, entry[key])
+        volumes.append(entry)
+    return volumes
@@ -0,0 +1,124 @@
+"""
+Episode Collate and Prefetcher
+Batches of episodes collated into their final tensor layout, and copied to the device in a
+background thread while the previous batch is trained on
+"""
+
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+# collated keys: (stacking axis, dtype)
+# support: Wa x Sh x B x ..., query: N x B x ...
+EPISODE_LAYOUT = {
+    "support_images": (2, torch.float32),  # Wa x Sh x B x C x H x W
+    "support_fg_labels": (2, torch.float32),  # Wa x Sh x B x H x W
+    "query_images": (1, torch.float32),  # N x B x C x H x W
+    "query_labels": (1, torch.int64),  # N x B x H x W
+    "episode_ids": (0, torch.int64),  # B x 2 (volume, class), TrainDataset only
+    "support_features": (2, torch.float16),  # Wa x Sh x B x C x H' x W', FeatureDataset only
+    "query_features": (1, torch.float16),  # N x B x C x H' x W', FeatureDataset only
+}
+
+
+def episode_collate(samples):
+    """
+    Stack a list of episodes into one contiguous tensor per key, in the layout used by FewShotSeg
+    """
+    batch = {}
+    for key, (axis, dtype) in EPISODE_LAYOUT.items():
+        if key not in samples[0]:
+            continue
+        arrays = [np.asarray(sample[key]) for sample in samples]
+        batch[key] = torch.from_numpy(np.stack(arrays, axis=axis)).to(dtype)
+    return batch
+
+
+class Prefetcher(object):
+    """
+    Iterates over a data loader in a background thread, keeping up to n_prefetch batches ready on
+    the device. Host tensors are pinned and copied with non_blocking=True on a separate CUDA
+    stream, so that the copies overlap with the forward/backward pass of the current batch
+    n_prefetch=0 loads every batch synchronously in the calling thread
+    wait_time is the time (s) the consumer spent waiting for batches during the last pass
+    """
+
+    _done = object()
+
+    def __init__(self, loader, device, n_prefetch=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.n_prefetch = n_prefetch
+        self.use_cuda = self.device.type == "cuda"
+        self.wait_time = 0.0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def to_device(self, batch):
+        """
+        Copy the tensors of a batch to the device (other values, e.g. ids, are kept as is)
+        """
+        out = {}
+        for key, val in batch.items():
+            if torch.is_tensor(val):
+                if self.use_cuda and not val.is_pinned():
+                    val = val.pin_memory()
+                val = val.to(self.device, non_blocking=self.use_cuda)
+            out[key] = val
+        return out
+
+    def worker(self, batches):
+        stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+        try:
+            for batch in self.loader:
+                event = None
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = self.to_device(batch)
+                    event = torch.cuda.Event()
+                    event.record(stream)
+                else:
+                    batch = self.to_device(batch)
+                batches.put((batch, event))
+        except Exception as e:
+            batches.put((e, None))
+        batches.put((self._done, None))
+
+    def __iter__(self):
+        self.wait_time = 0.0
+        if self.n_prefetch == 0:
+            batches = iter(self.loader)
+            while True:
+                tic = time.perf_counter()
+                batch = next(batches, self._done)
+                if batch is not self._done:
+                    batch = self.to_device(batch)
+                self.wait_time += time.perf_counter() - tic
+                if batch is self._done:
+                    return
+                yield batch
+
+        batches = queue.Queue(maxsize=self.n_prefetch)
+        thread = threading.Thread(target=self.worker, args=(batches,), daemon=True)
+        thread.start()
+        while True:
+            tic = time.perf_counter()
+            batch, event = batches.get()
+            self.wait_time += time.perf_counter() - tic
+            if batch is self._done:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            if event is not None:
+                # wait for the copies, and keep the memory of the copy stream alive
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_event(event)
+                for val in batch.values():
+                    if torch.is_tensor(val):
+                        val.record_stream(current_stream)
+            yield batch
+        thread.join()
@@ -0,0 +1,72 @@
+"""
+Volume Resampling
+Resizing on the corner-aligned grid of scipy.ndimage.zoom: batched trilinear interpolation
+(torch) for images, nearest neighbour gathering for labels
+"""
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def set_num_threads(n):
+    """
+    Set the number of intra-op threads of torch used for resizing (None keeps the current setting)
+    The setting is process-wide: call it once per loader process (e.g. as the initializer of
+    a process pool), never around single calls, which would race with other threads
+    """
+    if n is not None:
+        torch.set_num_threads(n)
+
+
+def get_new_shape(shape, new_shape):
+    """
+    Target shape, None entries keep the original size of an axis
+    """
+    return [shape[i] if s is None else s for i, s in enumerate(new_shape)]
+
+
+def get_nearest_indices(n_in, n_out):
+    """
+    Source index of each output index on the corner-aligned grid (align_corners=True)
+    """
+    return np.rint(np.linspace(0, n_in - 1, n_out)).astype(np.int64)
+
+
+def resample_volumes(vols, new_shape, is_label=False):
+    """
+    Resize a list of volumes (D x H x W), batching the images of equal shape in one call
+    Images and labels are sampled on the same grid, so that they stay aligned
+
+    Args:
+        vols: list of numpy arrays
+        new_shape: target shape, None entries keep the original size
+        is_label: nearest neighbour for label volumes (no interpolated label values),
+            trilinear (corners aligned, as scipy.ndimage.zoom) otherwise
+    """
+    if is_label:
+        out = []
+        for vol in vols:
+            size = get_new_shape(vol.shape, new_shape)
+            idx = [get_nearest_indices(n, m) for n, m in zip(vol.shape, size)]
+            out.append(vol[np.ix_(*idx)])
+        return out
+
+    groups = {}
+    for i, vol in enumerate(vols):
+        groups.setdefault(vol.shape, []).append(i)
+
+    out = [None] * len(vols)
+    for shape, idx in groups.items():
+        x = torch.from_numpy(np.stack([vols[i] for i in idx]).astype(np.float32))
+        x = x[:, None]  # N x 1 x D x H x W
+        size = get_new_shape(shape, new_shape)
+        with torch.no_grad():
+            x = F.interpolate(x, size=size, mode="trilinear", align_corners=True)
+        for i, vol in zip(idx, x[:, 0].numpy()):
+            out[i] = vol
+    return out
+
+
+def resample_volume(vol, new_shape, is_label=False):
+    return resample_volumes([vol], new_shape, is_label)[0]
@@ -0,0 +1,156 @@
+"""
+Sharded Dataset
+Preprocessed volumes packed into large binary shards that are streamed sequentially
+"""
+
+import itertools
+import json
+import os
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+
+from .datasets import EpisodeMixin, read_train_volume
+from .slice_index import build_slice_index, make_class_entry
+
+
+def write_shards(image_dirs, label_dirs, shard_dir, cache_dir=None, shard_size_mb=1024):
+    """
+    Pack resized, normalized image (float32) and label (uint8) volumes into binary shards of about shard_size_mb
+    Each shard_XXXXX.bin comes with a shard_XXXXX.json listing its volumes (shape, byte offsets,
+    per-class slices and foreground areas), and index.json lists the shards
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    shards = []
+    records = []
+    f = None
+    for image_dir, label_dir in zip(image_dirs, label_dirs):
+        if f is None:
+            name = f"shard_{len(shards):05d}"
+            f = open(os.path.join(shard_dir, f"{name}.bin"), "wb")
+
+        img, gt = read_train_volume(image_dir, label_dir, cache_dir)
+        record = {
+            "name": os.path.basename(image_dir).split(".nii")[0],
+            "shape": list(img.shape),
+            "image_offset": f.tell(),
+        }
+        f.write(np.ascontiguousarray(img, dtype=np.float32).tobytes())
+        record["label_offset"] = f.tell()
+        f.write(np.ascontiguousarray(gt, dtype=np.uint8).tobytes())
+        record["slice_index"] = {
+            str(cls): {"slices": entry["slices"].tolist(), "area": entry["area"].tolist()}
+            for cls, entry in build_slice_index(gt).items()
+        }
+        records.append(record)
+
+        if f.tell() >= shard_size_mb * 2**20 or image_dir == image_dirs[-1]:
+            f.close()
+            f = None
+            with open(os.path.join(shard_dir, f"{name}.json"), "w") as fj:
+                json.dump(records, fj)
+            shards.append(name)
+            records = []
+
+    with open(os.path.join(shard_dir, "index.json"), "w") as f:
+        json.dump({"shards": shards}, f)
+
+
+def read_shard(shard_dir, name):
+    """
+    Read one shard sequentially
+    Returns a list of (image, label, slice index) per volume
+    """
+    with open(os.path.join(shard_dir, f"{name}.json")) as f:
+        records = json.load(f)
+    buf = np.fromfile(os.path.join(shard_dir, f"{name}.bin"), dtype=np.uint8)
+
+    volumes = []
+    for record in records:
+        shape = record["shape"]
+        count = int(np.prod(shape))
+        img = np.frombuffer(
+            buf, dtype=np.float32, count=count, offset=record["image_offset"]
+        ).reshape(shape)
+        gt = np.frombuffer(
+            buf, dtype=np.uint8, count=count, offset=record["label_offset"]
+        ).reshape(shape)
+        index = {
+            int(cls): make_class_entry(entry["slices"], entry["area"])
+            for cls, entry in record["slice_index"].items()
+        }
+        volumes.append((img, gt, index))
+    return volumes
+
+
+class ShardedTrainDataset(EpisodeMixin, IterableDataset):
+    """
+    Streaming counterpart of TrainDataset
+    Every rank and worker reads a disjoint subset of the shards, one whole shard at a time
+    """
+
+    def __init__(self, args):
+        super().__init__(args)
+        if not self.use_gt:
+            raise ValueError("Shards hold ground truth labels, set use_gt=True")
+        self.shard_dir = args["shard_dir"]
+        self.episodes_per_volume = args["episodes_per_volume"]
+        with open(os.path.join(self.shard_dir, "index.json")) as f:
+            self.shards = json.load(f)["shards"]
+
+    def __len__(self):
+        return self.max_iter
+
+    def get_shards(self):
+        """
+        Shards of this rank/worker and the number of episodes it contributes to an epoch
+        """
+        rank, world_size = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+        worker_id, n_workers = 0, 1
+        info = get_worker_info()
+        if info is not None:
+            worker_id, n_workers = info.id, info.num_workers
+
+        n_readers = world_size * n_workers
+        shards = self.shards[rank * n_workers + worker_id :: n_readers]
+        if not shards:
+            raise ValueError(
+                f"{len(self.shards)} shards cannot be split over {n_readers} readers,"
+                " write smaller shards"
+            )
+
+        # every rank yields max_iter episodes, split over its workers
+        n_episodes = self.max_iter // n_workers + (worker_id < self.max_iter % n_workers)
+        return shards, n_episodes
+
+    def __iter__(self):
+        shards, n_episodes = self.get_shards()
+        self.get_rng().shuffle(shards)
+
+        n_done = 0
+        n_empty = 0  # successive shards without a valid episode
+        for shard in itertools.cycle(shards):
+            volumes = read_shard(self.shard_dir, shard)
+            episodes, weights = self.build_episode_table(
+                [index for _, _, index in volumes]
+            )
+            if not len(episodes):
+                n_empty += 1
+                if n_empty == len(shards):
+                    raise ValueError(
+                        f"None of the {len(shards)} shards of this reader has a class with"
+                        " enough successive slices for an episode"
+                    )
+                continue
+            n_empty = 0
+            for _ in range(self.episodes_per_volume * len(volumes)):
+                if n_done == n_episodes:
+                    return
+                rng = self.episode_rng()
+                vol, cls_idx, start = self.choose_episode(episodes, weights, rng)
+                img, lbl, _ = volumes[vol]
+                n_done += 1
+                yield self.make_episode(img, lbl, cls_idx, start, rng)
@@ -0,0 +1,96 @@
+"""
+Slice Index
+Per-volume lookup tables of the slices containing each class, their foreground area and the runs
+of successive slices, so that episodes are sampled without scanning the volume
+"""
+
+import numpy as np
+
+
+def get_runs(slices):
+    """
+    Runs of successive slice indices as a K x 2 array of [start, stop)
+    """
+    if not len(slices):
+        return np.zeros((0, 2), dtype=np.int64)
+    breaks = np.nonzero(np.diff(slices) != 1)[0] + 1
+    starts = slices[np.concatenate(([0], breaks))]
+    stops = slices[np.concatenate((breaks - 1, [len(slices) - 1]))] + 1
+    return np.stack((starts, stops), axis=1)
+
+
+def make_class_entry(slices, area):
+    slices = np.asarray(slices, dtype=np.int64)
+    return {
+        "slices": slices,
+        "area": np.asarray(area, dtype=np.int64),
+        "runs": get_runs(slices),
+    }
+
+
+def build_slice_index(lbl):
+    """
+    Args:
+        lbl: label volume, D x H x W
+    Returns:
+        dict {class: {"slices": slice indices containing the class,
+                      "area": foreground pixels of the class on these slices,
+                      "runs": K x 2 [start, stop) runs of successive slices}},
+        background excluded
+    """
+    n_classes = int(lbl.max()) + 1
+    areas = np.stack(
+        [np.bincount(sli.ravel(), minlength=n_classes) for sli in lbl]
+    )  # D x n_classes
+
+    index = {}
+    for cls in np.nonzero(areas[:, 1:].any(axis=0))[0] + 1:
+        slices = np.nonzero(areas[:, cls])[0]
+        index[int(cls)] = make_class_entry(slices, areas[slices, cls])
+    return index
+
+
+def build_episode_table(slice_indices, n_episode_slices, min_size, exclude_classes=()):
+    """
+    All valid episodes of a list of volumes as an E x 3 array of (volume, class, first slice)
+    An episode is valid if its n_episode_slices successive slices all contain the class and the
+    class covers at least min_size pixels on its first or second slice
+    """
+    rows = []
+    for vol, index in enumerate(slice_indices):
+        for cls, entry in index.items():
+            if cls in exclude_classes:
+                continue
+            for start, stop in entry["runs"]:
+                if stop - start < n_episode_slices:
+                    continue
+                starts = np.arange(start, stop - n_episode_slices + 1)
+                pos = np.searchsorted(entry["slices"], start) + (starts - start)
+                size = np.maximum(entry["area"][pos], entry["area"][pos + 1])
+                starts = starts[size >= min_size]
+                rows.append(
+                    np.stack(
+                        (np.full_like(starts, vol), np.full_like(starts, cls), starts),
+                        axis=1,
+                    )
+                )
+    if not rows:
+        return np.zeros((0, 3), dtype=np.int64)
+    return np.concatenate(rows).astype(np.int64)
+
+
+def get_episode_weights(table, weighting="uniform"):
+    """
+    Sampling probabilities of the episodes of a table
+    uniform: every episode equally likely; class: every class equally likely
+    """
+    if weighting == "uniform":
+        weights = np.ones(len(table))
+    elif weighting == "class":
+        _, inverse, counts = np.unique(
+            table[:, 1], return_inverse=True, return_counts=True
+        )
+        weights = 1.0 / counts[inverse]
+    else:
+        raise ValueError(f"Episode weighting: {weighting} not found")
+    return weights / weights.sum()
@@ -0,0 +1,90 @@
+"""
+Supervoxels
+3D SLIC supervoxels of the resized training volumes, used as pseudo-labels for self-supervised
+training (use_gt=False) and stored as uint16 volumes next to the volume cache
+"""
+
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from skimage.segmentation import slic
+
+from .resampling import set_num_threads
+from .volume_cache import atomic_save, get_cache_path, load_volume
+
+
+def make_supervoxels(img, n_sv, compactness=0.1):
+    """
+    About n_sv SLIC supervoxels of a normalized volume (D x H x W), labelled 1..K in uint16
+    Voxels at the minimum intensity (air, padding) are left as background 0
+    """
+    mask = img > img.min()
+    if not mask.any():
+        return np.zeros(img.shape, dtype=np.uint16)
+    sv = slic(
+        np.asarray(img, dtype=np.float64),
+        n_segments=n_sv,
+        compactness=compactness,
+        channel_axis=None,
+        start_label=1,
+        mask=mask,
+    )
+    return sv.astype(np.uint16)
+
+
+def get_supervoxel_path(cache_dir, image_path, new_shape, n_sv, compactness):
+    # derived from the key of the cached image, so that a modified image invalidates it
+    image_cache_path = get_cache_path(cache_dir, image_path, new_shape)
+    return f"{image_cache_path[: -len('.npy')]}_sv{n_sv}_c{compactness:g}.npy"
+
+
+def build_supervoxel_entry(image_path, new_shape, cache_dir, n_sv, compactness=0.1):
+    sv_path = get_supervoxel_path(cache_dir, image_path, new_shape, n_sv, compactness)
+    if not os.path.exists(sv_path):
+        img = load_volume(image_path, new_shape, cache_dir)
+        sv = make_supervoxels(img, n_sv, compactness)
+        atomic_save(sv_path, lambda f: np.save(f, sv))
+    return sv_path
+
+
+def load_supervoxels(image_path, new_shape, n_sv, cache_dir=None, compactness=0.1):
+    """
+    Supervoxels of a resized volume, memory-mapped from the cache (generated on first use)
+    """
+    if cache_dir is None:
+        img = load_volume(image_path, new_shape)
+        return make_supervoxels(img, n_sv, compactness)
+    sv_path = build_supervoxel_entry(image_path, new_shape, cache_dir, n_sv, compactness)
+    return np.load(sv_path, mmap_mode="r")
+
+
+def build_supervoxels(
+    image_dirs, new_shape, cache_dir, n_sv, compactness=0.1, n_workers=8, n_threads=None
+):
+    """
+    One-time supervoxel generation for a list of images, in parallel over n_workers processes
+    of n_threads resizing threads each
+    """
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=mp.get_context("spawn"),
+        initializer=set_num_threads,
+        initargs=(n_threads,),
+    ) as pool:
+        jobs = [
+            pool.submit(
+                build_supervoxel_entry,
+                image_dir,
+                new_shape,
+                cache_dir,
+                n_sv,
+                compactness,
+            )
+            for image_dir in image_dirs
+        ]
+        for n_done, job in enumerate(as_completed(jobs), 1):
+            job.result()
+            print(f"\rSupervoxels of {n_done}/{len(jobs)} volumes", end="", flush=True)
+        print()
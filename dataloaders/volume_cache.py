@@ -0,0 +1,108 @@
+"""
+Preprocessed Volume Cache
+Resized and label-remapped (or normalized) volumes stored as .npy files, opened memory-mapped
+"""
+
+import hashlib
+import os
+import threading
+
+import numpy as np
+import SimpleITK as sitk
+
+from .resampling import resample_volume
+
+# raw label values -> class index
+LABEL_MAP = {200: 1, 500: 2, 600: 3}
+
+
+def atomic_save(path, write_fn, mode="wb"):
+    """
+    Write a file with write_fn(f) into a temporary file renamed to path, so that concurrent
+    readers never see a partial file
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, mode) as f:
+            write_fn(f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def remap_labels(lbl):
+    for src, dst in LABEL_MAP.items():
+        lbl[lbl == src] = dst
+    return lbl
+
+
+def normalize_volume(img):
+    """
+    Zero mean, unit variance float32 volume (statistics accumulated in float64)
+    """
+    img = img.astype(np.float32)
+    img -= np.float32(img.mean(dtype=np.float64))
+    img /= np.float32(img.std(dtype=np.float64))
+    return img
+
+
+def read_volume(path, new_shape, is_label=False):
+    """
+    Read a NIfTI volume and resize it to new_shape (None keeps the original size of an axis)
+    Labels are resampled with nearest neighbours, so remapping only sees raw label values
+    Returns uint8 labels or normalized float32 images
+    """
+    vol = sitk.GetArrayFromImage(sitk.ReadImage(path))
+    vol = resample_volume(vol, new_shape, is_label)
+    if is_label:
+        return remap_labels(vol).astype(np.uint8)
+    return normalize_volume(vol)
+
+
+def get_cache_path(cache_dir, path, new_shape, is_label=False):
+    """
+    Cache entries are keyed by source file, modification time, target shape and resampling method
+    """
+    key = "|".join(
+        [
+            os.path.abspath(path),
+            str(os.stat(path).st_mtime_ns),
+            str(list(new_shape)),
+            "label" if is_label else "image",
+            "torch-corners",
+            "normalized",
+        ]
+    )
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    name = os.path.basename(path).split(".nii")[0]
+    return os.path.join(cache_dir, f"{name}_{digest}.npy")
+
+
+def build_cache_entry(path, new_shape, cache_dir, is_label=False):
+    cache_path = get_cache_path(cache_dir, path, new_shape, is_label)
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        vol = read_volume(path, new_shape, is_label)
+        atomic_save(cache_path, lambda f: np.save(f, vol))
+    return cache_path
+
+
+def load_volume(path, new_shape, cache_dir=None, is_label=False):
+    """
+    Load a resized volume, memory-mapped from the cache if cache_dir is given
+    Image volumes are returned normalized (zero mean, unit variance) in float32
+    """
+    if cache_dir is None:
+        return read_volume(path, new_shape, is_label)
+    cache_path = build_cache_entry(path, new_shape, cache_dir, is_label)
+    return np.load(cache_path, mmap_mode="r")
+
+
+def build_cache(image_dirs, label_dirs, new_shape, cache_dir):
+    """
+    One-time cache builder for a list of image/label pairs
+    """
+    for image_dir, label_dir in zip(image_dirs, label_dirs):
+        build_cache_entry(image_dir, new_shape, cache_dir)
+        build_cache_entry(label_dir, new_shape, cache_dir, True)
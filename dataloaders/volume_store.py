@@ -0,0 +1,67 @@
+"""
+Shared-memory Volume Store
+Volumes concatenated along the slice axis into one shared memory block with an offset table,
+so that DataLoader workers attach to the same pages instead of copying them
+"""
+
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class VolumeStore(object):
+    def __init__(self, n_slices, slice_shape=(256, 256), dtype=np.float32):
+        """
+        Args:
+            n_slices: number of slices of each volume
+            slice_shape: in-plane size shared by all volumes
+            dtype: data type of the stored volumes
+        """
+        self.offsets = np.cumsum([0] + list(n_slices))
+        self.shape = (int(self.offsets[-1]),) + tuple(slice_shape)
+        self.dtype = np.dtype(dtype)
+
+        nbytes = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self._shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self._owner_pid = os.getpid()
+        self.data = np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.data[self.offsets[idx] : self.offsets[idx + 1]]
+
+    def __setitem__(self, idx, vol):
+        self.data[self.offsets[idx] : self.offsets[idx + 1]] = vol
+
+    def __getstate__(self):
+        # only the name of the block is pickled (spawned workers)
+        state = self.__dict__.copy()
+        state["_shm"] = self._shm.name
+        del state["data"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # workers share the resource tracker of the creating process, whose registration of
+        # the block (unlinked after a crash) must be kept: attaching does not unregister it
+        self._shm = shared_memory.SharedMemory(name=state["_shm"])
+        self.data = np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+
+    def close(self):
+        if getattr(self, "_shm", None) is None:
+            return
+        del self.data
+        try:
+            self._shm.close()
+        except BufferError:
+            pass  # views of the block are still alive, the mapping goes with them
+        # forked workers inherit this object, only the creating process frees the block
+        if os.getpid() == self._owner_pid:
+            self._shm.unlink()
+        self._shm = None
+
+    def __del__(self):
+        self.close()
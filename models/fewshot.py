@@ -14,11 +14,12 @@ class FewShotSeg(nn.Module):
     def __init__(
         self,
         use_coco_init=True,
+        in_channels=1,
     ):
         super().__init__()
 
-        # Encoder
-        self.encoder = TVDeeplabRes101Encoder(use_coco_init)
+        # Encoder, grayscale input by default (in_channels=3 for replicated RGB input)
+        self.encoder = TVDeeplabRes101Encoder(use_coco_init, in_channels=in_channels)
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.t = Parameter(torch.Tensor([-10.0]))
         self.scaler = 20.0
@@ -29,7 +30,7 @@ class FewShotSeg(nn.Module):
         self.conv_fusion = nn.Conv2d(256 + 1, 256, kernel_size=1)
 
     def generate_prior(self, query_feat, supp_feat, s_y, fts_size):
-        bsize, _, sp_sz, _ = query_feat.size()[:]
+        bsize, _, sp_h, sp_w = query_feat.size()[:]
         cosine_eps = 1e-7
 
         tmp_mask = (s_y == 1).float().unsqueeze(1)
@@ -60,13 +61,13 @@ class FewShotSeg(nn.Module):
         similarity = torch.bmm(tmp_supp, tmp_query) / (
             torch.bmm(tmp_supp_norm, tmp_query_norm) + cosine_eps
         )
-        similarity = similarity.max(1)[0].view(bsize, sp_sz * sp_sz)
+        similarity = similarity.max(1)[0].view(bsize, sp_h * sp_w)
         similarity = (similarity - similarity.min(1)[0].unsqueeze(1)) / (
             similarity.max(1)[0].unsqueeze(1)
             - similarity.min(1)[0].unsqueeze(1)
             + cosine_eps
         )
-        corr_query = similarity.view(bsize, 1, sp_sz, sp_sz)
+        corr_query = similarity.view(bsize, 1, sp_h, sp_w)
         corr_query = F.interpolate(
             corr_query,
             size=(fts_size[0], fts_size[1]),
@@ -84,32 +85,24 @@ class FewShotSeg(nn.Module):
         train=False,
         t_loss_scaler=1,
         n_cmat=1,
-        n_iters=1,
     ):
         """
         Args:
             supp_imgs: support images
-                way x shot x [B x 3 x H x W], list of lists of tensors
+                way x shot x [B x 1 x H x W], list of lists of tensors
             fore_mask: foreground masks for support images
                 way x shot x [B x H x W], list of lists of tensors
             back_mask: background masks for support images
                 way x shot x [B x H x W], list of lists of tensors
             qry_imgs: query images
-                N x [B x 3 x H x W], list of tensors
+                N x [B x 1 x H x W], list of tensors
         """
 
         n_ways = len(supp_imgs)
-        self.n_shots = len(supp_imgs[0])
-        self.n_ways = len(supp_imgs)
-        self.n_shots = len(supp_imgs[0])
-        self.n_queries = len(qry_imgs)
-        assert (
-            self.n_ways == 1
-        )  # for now only one-way, because not every shot has multiple sub-images
-        assert self.n_queries == 1
+        n_shots = len(supp_imgs[0])
         n_queries = len(qry_imgs)
-        self.batch_size_q = qry_imgs[0].shape[0]
-        self.batch_size = supp_imgs[0][0].shape[0]
+        batch_size_q = qry_imgs[0].shape[0]
+        batch_size = supp_imgs[0][0].shape[0]
         img_size = supp_imgs[0][0].shape[-2:]
 
         # ###### Extract features ######
@@ -123,15 +116,122 @@ class FewShotSeg(nn.Module):
         img_fts = self.encoder(imgs_concat, low_level=False)
 
         fts_size = img_fts.shape[-2:]
-        supp_fts = img_fts[: n_ways * self.n_shots * self.batch_size].view(
-            n_ways, self.n_shots, self.batch_size, -1, *fts_size
+        supp_fts = img_fts[: n_ways * n_shots * batch_size].view(
+            n_ways, n_shots, batch_size, -1, *fts_size
         )  # Wa x Sh x B x C x H' x W'
-        qry_fts = img_fts[n_ways * self.n_shots * self.batch_size :].view(
-            n_queries, self.batch_size_q, -1, *fts_size
+        qry_fts = img_fts[n_ways * n_shots * batch_size :].view(
+            n_queries, batch_size_q, -1, *fts_size
         )  # N x B x C x H' x W'
 
+        return self.forward_features(
+            supp_fts, fore_mask, qry_fts, img_size, train, n_cmat
+        )
+
+    def encode_support(self, supp_imgs, fore_mask):
+        """
+        Encode a support set once, to segment any number of queries with segment() (eval mode)
+        Only the encoder and the first self-attention of the support are independent of the
+        query, the later CMAT rounds attend to the query and are computed in segment()
+        Args:
+            supp_imgs: support images
+                way x shot x [B x 1 x H x W], list of lists of tensors
+            fore_mask: foreground masks for support images
+                way x shot x [B x H x W], list of lists of tensors
+        """
+        n_ways = len(supp_imgs)
+        n_shots = len(supp_imgs[0])
+        batch_size = supp_imgs[0][0].shape[0]
+
+        supp_fts = self.encoder(
+            torch.cat([torch.cat(way, dim=0) for way in supp_imgs], dim=0),
+            low_level=False,
+        )
+        supp_fts = self.self_attention(supp_fts)
+        return {
+            "supp_fts": supp_fts.view(
+                n_ways, n_shots, batch_size, -1, *supp_fts.shape[-2:]
+            ),  # Wa x Sh x B x C x H' x W'
+            "fore_mask": fore_mask,
+            "img_size": supp_imgs[0][0].shape[-2:],
+        }
+
+    def segment(self, support, qry_imgs, n_cmat=1):
+        """
+        Segment queries against a support set encoded by encode_support()
+        A support of batch size 1 is shared by a batch of query slices (e.g. of one volume),
+        each slice being segmented as if it were alone
+        Args:
+            support: support state returned by encode_support()
+            qry_imgs: query images
+                N x [B x 1 x H x W], list of tensors
+        """
+        n_queries = len(qry_imgs)
+        batch_size_q = qry_imgs[0].shape[0]
+        qry_fts = self.encoder(torch.cat(qry_imgs, dim=0), low_level=False)
+        qry_fts = qry_fts.view(n_queries, batch_size_q, -1, *qry_fts.shape[-2:])
+
+        supp_fts = support["supp_fts"]
+        fore_mask = support["fore_mask"]
+        if supp_fts.shape[2] != batch_size_q:
+            # one copy of the support per query slice, attended by that slice only
+            supp_fts = supp_fts.expand(-1, -1, batch_size_q, -1, -1, -1).contiguous()
+            fore_mask = [
+                [mask.expand(batch_size_q, -1, -1) for mask in way] for way in fore_mask
+            ]
+
+        query_mask, _ = self.forward_features(
+            supp_fts,
+            fore_mask,
+            qry_fts,
+            support["img_size"],
+            train=False,
+            n_cmat=n_cmat,
+            supp_attended=True,
+        )
+        return query_mask
+
+    def get_query_batch_size(self, img_size, memory_mb):
+        """
+        Number of query slices segmented by one segment() call within about memory_mb of
+        activations (fp32). Per slice, the largest are the support features upsampled to the
+        image size to extract the prototype, the attention maps and the encoder output
+        """
+        height, width = img_size
+        n_fts = (height // 8) * (width // 8)  # output stride 8
+        n_floats = 2 * 256 * height * width + 2 * n_fts**2 + 2 * 2048 * n_fts
+        return max(1, int(memory_mb * 2**20 // (4 * n_floats)))
+
+    def forward_features(
+        self,
+        supp_fts,
+        fore_mask,
+        qry_fts,
+        img_size,
+        train=False,
+        n_cmat=1,
+        supp_attended=False,
+    ):
+        """
+        Segment from encoder features (e.g. precomputed with a frozen encoder)
+        Args:
+            supp_fts: support features, Wa x Sh x B x C x H' x W'
+            fore_mask: foreground masks for support images
+                way x shot x [B x H x W], list of lists of tensors
+            qry_fts: query features, N x B x C x H' x W'
+            img_size: (H, W) of the images and masks
+            supp_attended: supp_fts already went through the first self-attention
+        """
+        self.n_ways, self.n_shots, self.batch_size = supp_fts.shape[:3]
+        self.n_queries, self.batch_size_q = qry_fts.shape[:2]
+        assert (
+            self.n_ways == 1
+        )  # for now only one-way, because not every shot has multiple sub-images
+        assert self.n_queries == 1
+        assert self.batch_size == self.batch_size_q  # one query per support
+        fts_size = qry_fts.shape[-2:]
+
         align_loss = torch.zeros(1).to(self.device)
-        for _ in range(n_cmat):
+        for i in range(n_cmat):
             supp_fts, qry_fts, query_mask, align_loss2 = self.CMAT(
                 supp_fts,
                 fore_mask,
@@ -140,7 +240,7 @@ class FewShotSeg(nn.Module):
                 img_size,
                 fts_size,
                 train,
-                n_iters,
+                supp_attended and i == 0,
             )
             align_loss += align_loss2
         align_loss /= n_cmat
@@ -159,7 +259,7 @@ class FewShotSeg(nn.Module):
         img_size,
         fts_size,
         train,
-        n_iters,
+        supp_attended=False,
     ):
         # Reshape for self_attention
         supp_fts_reshaped = supp_fts.view(
@@ -167,8 +267,9 @@ class FewShotSeg(nn.Module):
         )  # (Wa*Sh*B) x C x H' x W'
         qry_fts_reshaped = qry_fts.view(-1, *qry_fts.shape[-3:])  # (N*B) x C x H' x W'
 
-        # Self attention
-        supp_fts_reshaped = self.self_attention(supp_fts_reshaped)
+        # Self attention (of the support: unless cached by encode_support)
+        if not supp_attended:
+            supp_fts_reshaped = self.self_attention(supp_fts_reshaped)
         qry_fts_reshaped = self.self_attention(qry_fts_reshaped)
 
         # Reshape back to original size
@@ -189,7 +290,7 @@ class FewShotSeg(nn.Module):
         )  # (N * B) x C x H' x W'
         supp_fts1 = supp_fts.view(self.batch_size, -1, *fts_size)  # B x C x H' x W'
         fore_mask1 = fore_mask[0][0]  # B x H' x W'
-        corr_query_mask = self.generate_prior(qry_fts1, supp_fts1, fore_mask1, (32, 32))
+        corr_query_mask = self.generate_prior(qry_fts1, supp_fts1, fore_mask1, fts_size)
 
         # Reshape corr_query_mask from (N * B) x 1 x H' x W' to N x B x 1 x H' x W'
         query_mask = corr_query_mask.view(
@@ -206,164 +307,54 @@ class FewShotSeg(nn.Module):
 
         # Pass through CrossAttention
         supp_fts_out, qry_fts_out = self.cross_attention(
-            supp_fts_reshaped, qry_fts_reshaped, fore_mask1, query_mask[0][0]
+            supp_fts_reshaped,
+            qry_fts_reshaped,
+            fore_mask1,
+            query_mask.view(-1, *fts_size),
         )
 
         # Reshape back to original shape
         supp_fts = supp_fts_out.view(*supp_fts.shape)
         qry_fts = qry_fts_out.view(*qry_fts.shape)
 
-        ###### Compute loss ######
-        align_loss = torch.zeros(1).to(self.device)
-        outputs = []
-        for epi in range(self.batch_size):
-            ###### Extract prototypes ######
-            supp_fts_ = [
-                [
-                    self.getFeatures(
-                        supp_fts[way, shot, [epi]], fore_mask[way, shot, [epi]]
-                    )
-                    for shot in range(self.n_shots)
-                ]
-                for way in range(self.n_ways)
-            ]
-
-            fg_prototypes = self.getPrototype(supp_fts_)
-            anom_s = [
-                self.negSim(qry_fts[epi], prototype) for prototype in fg_prototypes
-            ]
-
-            ###### Get threshold #######
-            self.thresh_pred = [self.t for _ in range(self.n_ways)]
-            self.t_loss = self.t / self.scaler
-
-            ###### Get predictions #######
-            pred = self.getPred(anom_s, self.thresh_pred)  # N x Wa x H' x W'
-
-            qry_fts1 = [qry_fts]
-            fg_prototypes1 = [fg_prototypes]
-            qry_prediction = [
-                torch.stack(
-                    [
-                        self.getPrediction(
-                            qry_fts1[n][epi],
-                            fg_prototypes1[n][way],
-                            self.thresh_pred[way],
-                        )
-                        for way in range(self.n_ways)
-                    ],
-                    dim=1,
-                )
-                for n in range(len(qry_fts1))
-            ]  # N x Wa x H' x W'
-
-            ###### Prototype Refinement  ######
-            fg_prototypes_ = []
-            if (not train) and n_iters > 0:  # iteratively update prototypes
-                for n in range(len(qry_fts1)):
-                    fg_prototypes_.append(
-                        self.updatePrototype(
-                            qry_fts1[n],
-                            fg_prototypes1[n],
-                            qry_prediction[n],
-                            n_iters,
-                            epi,
-                        )
-                    )
-
-                qry_prediction = [
-                    torch.stack(
-                        [
-                            self.getPrediction(
-                                qry_fts1[n][epi],
-                                fg_prototypes_[n][way],
-                                self.thresh_pred[way],
-                            )
-                            for way in range(self.n_ways)
-                        ],
-                        dim=1,
-                    )
-                    for n in range(len(qry_fts1))
-                ]  # N x Wa x H' x W'
-
-            pred_ups = [
-                F.interpolate(
-                    qry_prediction[n],
-                    size=img_size,
-                    mode="bilinear",
-                    align_corners=True,
-                )
-                for n in range(len(qry_fts1))
+        ###### Extract prototypes ######
+        supp_fts_ = [
+            [
+                self.getFeatures(supp_fts[way, shot], fore_mask[way, shot])
+                for shot in range(self.n_shots)
             ]
+            for way in range(self.n_ways)
+        ]  # Wa x Sh x [B x C]
+        fg_prototypes = self.getPrototype(supp_fts_)  # Wa x [B x C]
+        anom_s = [
+            self.negSim(qry_fts[0], prototype) for prototype in fg_prototypes
+        ]  # one query per episode (N = 1)
+
+        ###### Get threshold #######
+        self.thresh_pred = [self.t for _ in range(self.n_ways)]
+        self.t_loss = self.t / self.scaler
+
+        ###### Get predictions #######
+        pred = self.getPred(anom_s, self.thresh_pred)  # B x Wa x H' x W'
+
+        pred_ups = F.interpolate(
+            pred, size=img_size, mode="bilinear", align_corners=True
+        )
+        output = torch.cat((1.0 - pred_ups, pred_ups), dim=1)  # B x (1 + Wa) x H x W
 
-            pred_ups = F.interpolate(
-                pred, size=img_size, mode="bilinear", align_corners=True
-            )
-            pred_ups = torch.cat((1.0 - pred_ups, pred_ups), dim=1)
-
-            outputs.append(pred_ups)
-
-            ###### Prototype alignment loss ######
-            if train:
-                align_loss_epi = self.alignLoss(
+        ###### Prototype alignment loss ######
+        align_loss = torch.zeros(1).to(self.device)
+        if train:
+            for epi in range(self.batch_size):
+                align_loss += self.alignLoss(
                     qry_fts[:, epi],
-                    torch.cat((1.0 - pred, pred), dim=1),
+                    torch.cat((1.0 - pred[[epi]], pred[[epi]]), dim=1),
                     supp_fts[:, :, epi],
                     fore_mask[:, :, epi],
                 )
-                align_loss += align_loss_epi
-
-        output = torch.stack(outputs, dim=1)  # N x B x (1 + Wa) x H x W
-        output = output.view(-1, *output.shape[2:])
 
         return supp_fts, qry_fts, output, align_loss
 
-    def updatePrototype(self, fts, prototype, pred, update_iters, epi):
-        prototype_ = Parameter(torch.stack(prototype, dim=0))
-
-        optimizer = torch.optim.Adam([prototype_], lr=0.01)
-
-        while update_iters > 0:
-            with torch.enable_grad():
-                pred_mask = torch.sum(pred, dim=-3)
-                pred_mask = torch.stack((1.0 - pred_mask, pred_mask), dim=1).argmax(
-                    dim=1, keepdim=True
-                )
-                pred_mask = pred_mask.repeat([*fts.shape[1:-2], 1, 1])
-                bg_fts = fts[epi] * (1 - pred_mask)
-                fg_fts = torch.zeros_like(fts[epi])
-                for way in range(self.n_ways):
-                    fg_fts += (
-                        prototype_[way].unsqueeze(-1).unsqueeze(-1).repeat(*pred.shape)
-                        * pred_mask[way][None, ...]
-                    )
-                new_fts = bg_fts + fg_fts
-                fts_norm = torch.sigmoid(
-                    (fts[epi] - fts[epi].min()) / (fts[epi].max() - fts[epi].min())
-                )
-                new_fts_norm = torch.sigmoid(
-                    (new_fts - new_fts.min()) / (new_fts.max() - new_fts.min())
-                )
-                bce_loss = nn.BCELoss()
-                loss = bce_loss(fts_norm, new_fts_norm)
-
-            optimizer.zero_grad()
-            # loss.requires_grad_()
-            loss.backward()
-            optimizer.step()
-
-            pred = torch.stack(
-                [
-                    self.getPrediction(fts[epi], prototype_[way], self.thresh_pred[way])
-                    for way in range(self.n_ways)
-                ],
-                dim=1,
-            )  # N x Wa x H' x W'
-
-            update_iters += -1
-
-        return prototype_
-
     def negSim(self, fts, prototype):
         """
         Calculate the distance between features and prototypes
@@ -384,16 +375,16 @@ class FewShotSeg(nn.Module):
         Extract foreground and background features via masked average pooling
 
         Args:
-            fts: input features, expect shape: 1 x C x H' x W'
-            mask: binary mask, expect shape: 1 x H x W
+            fts: input features, expect shape: B x C x H' x W'
+            mask: binary mask, expect shape: B x H x W
         """
 
         fts = F.interpolate(fts, size=mask.shape[-2:], mode="bilinear")
 
         # masked fg features
-        masked_fts = torch.sum(fts * mask[None, ...], dim=(2, 3)) / (
-            mask[None, ...].sum(dim=(2, 3)) + 1e-5
-        )  # 1 x C
+        masked_fts = torch.sum(fts * mask[:, None, ...], dim=(2, 3)) / (
+            mask[:, None, ...].sum(dim=(2, 3)) + 1e-5
+        )  # B x C
 
         return masked_fts
 
@@ -403,17 +394,16 @@ class FewShotSeg(nn.Module):
 
         Args:
             fg_fts: lists of list of foreground features for each way/shot
-                expect shape: Wa x Sh x [1 x C]
+                expect shape: Wa x Sh x [B x C]
             bg_fts: lists of list of background features for each way/shot
-                expect shape: Wa x Sh x [1 x C]
+                expect shape: Wa x Sh x [B x C]
         """
 
         n_ways, n_shots = len(fg_fts), len(fg_fts[0])
         fg_prototypes = [
-            torch.sum(torch.cat([tr for tr in way], dim=0), dim=0, keepdim=True)
-            / n_shots
+            torch.sum(torch.stack([tr for tr in way], dim=0), dim=0) / n_shots
             for way in fg_fts
-        ]  ## concat all fg_fts
+        ]  ## stack all fg_fts, Wa x [B x C]
 
         return fg_prototypes
 
@@ -476,21 +466,25 @@ class FewShotSeg(nn.Module):
 
         return torch.stack(pred, dim=1)  # N x Wa x H' x W'
 
-    def getPrediction(self, fts, prototype, thresh):
-        """
-        Calculate the distance between features and prototypes
 
-        Args:
-            fts: input features
-                expect shape: N x C x H x W
-            prototype: prototype of one semantic class
-                expect shape: 1 x C
-        """
-
-        sim = -F.cosine_similarity(fts, prototype[..., None, None], dim=1) * self.scaler
-        pred = 1.0 - torch.sigmoid(0.5 * (sim - thresh))
+class SpatialLayerNorm(nn.LayerNorm):
+    """
+    LayerNorm over C x H x W for inputs of any spatial size
+    The affine parameters, learned at normalized_shape (256 x 32 x 32 for 256 x 256 slices), are
+    bilinearly resized to the size of the input, e.g. for ROI-cropped episodes
+    """
 
-        return pred
+    def forward(self, x):
+        shape = tuple(x.shape[-3:])
+        if shape == tuple(self.normalized_shape):
+            return super().forward(x)
+        weight = F.interpolate(
+            self.weight[None], size=shape[-2:], mode="bilinear", align_corners=True
+        )[0]
+        bias = F.interpolate(
+            self.bias[None], size=shape[-2:], mode="bilinear", align_corners=True
+        )[0]
+        return F.layer_norm(x, shape, weight, bias, self.eps)
 
 
 class SelfAttention(nn.Module):
@@ -501,7 +495,7 @@ class SelfAttention(nn.Module):
         self.value = nn.Conv2d(dim, dim, 1)
         self.softmax = nn.Softmax(dim=-2)
         self.mlp = nn.Sequential(nn.Linear(dim, dim), nn.ReLU(), nn.Linear(dim, dim))
-        self.norm = nn.LayerNorm([256, 32, 32])
+        self.norm = SpatialLayerNorm([256, 32, 32])
 
     def forward(self, x):
         B, C, H, W = x.shape
@@ -524,7 +518,7 @@ class CrossAttention(nn.Module):
         self.value = nn.Conv2d(dim, dim, 1)
         self.softmax = nn.Softmax(dim=-1)
         self.mlp = nn.Sequential(nn.Linear(dim, dim), nn.ReLU(), nn.Linear(dim, dim))
-        self.norm = nn.LayerNorm([256, 32, 32])
+        self.norm = SpatialLayerNorm([256, 32, 32])
 
     def forward(self, x, y, s_mask=None, q_mask=None):
         B, C, H, W = x.shape
@@ -537,7 +531,7 @@ class CrossAttention(nn.Module):
         outx = torch.bmm(vy, attn.permute(0, 2, 1)).view(B, C, H, W)  # B, C, H, W
 
         if s_mask is not None:
-            mask = s_mask.unsqueeze(0)
+            mask = s_mask.unsqueeze(1)
             mask = F.interpolate(
                 mask,
                 size=(H, W),
@@ -562,7 +556,7 @@ class CrossAttention(nn.Module):
         outy = torch.bmm(vx, attn.permute(0, 2, 1)).view(B, C, H, W)  # B, C, H, W
 
         if q_mask is not None:
-            mask = q_mask.unsqueeze(0)
+            mask = q_mask.unsqueeze(1)
             mask = F.interpolate(
                 mask,
                 size=(H, W),
@@ -1,15 +1,39 @@
+import torch
 import torch.nn as nn
 import torchvision
 from torchvision.models.segmentation import DeepLabV3_ResNet101_Weights
 
 
+def sum_input_channels(conv):
+    """
+    Single input channel copy of a convolution, conv(x) == conv([x, ..., x]) for the original
+    """
+    new_conv = nn.Conv2d(
+        1,
+        conv.out_channels,
+        kernel_size=conv.kernel_size,
+        stride=conv.stride,
+        padding=conv.padding,
+        dilation=conv.dilation,
+        groups=conv.groups,
+        bias=conv.bias is not None,
+    )
+    with torch.no_grad():
+        new_conv.weight.copy_(conv.weight.sum(dim=1, keepdim=True))
+        if conv.bias is not None:
+            new_conv.bias.copy_(conv.bias)
+    return new_conv
+
+
 class TVDeeplabRes101Encoder(nn.Module):
     """
     FCN-Resnet101 backbone from torchvision deeplabv3
     No ASPP is used as we found emperically it hurts performance
+    With in_channels=1, conv1 takes grayscale input directly: its pretrained weights are summed
+    over the RGB axis, which gives the same outputs as replicating the image over 3 channels
     """
 
-    def __init__(self, use_coco_init, aux_dim_keep=64, use_aspp=False):
+    def __init__(self, use_coco_init, aux_dim_keep=64, use_aspp=False, in_channels=3):
         super().__init__()
         _model = torchvision.models.segmentation.deeplabv3_resnet101(
             weights=DeepLabV3_ResNet101_Weights.DEFAULT,
@@ -24,6 +48,10 @@ class TVDeeplabRes101Encoder(nn.Module):
         # print(_model_list)
         self.aux_dim_keep = aux_dim_keep
         self.backbone = _model_list[0]
+        if in_channels == 1:
+            self.backbone.conv1 = sum_input_channels(self.backbone.conv1)
+        elif in_channels != 3:
+            raise ValueError(f"Encoder input channels: {in_channels} not supported")
         # print()
         # print(self.backbone)
         # log.info(self.backbone)
@@ -37,6 +65,18 @@ class TVDeeplabRes101Encoder(nn.Module):
         self.aspp_out = nn.Sequential(*[_aspp, _conv256])
         self.use_aspp = use_aspp
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints of the 3-channel encoder load into the 1-channel encoder
+        key = prefix + "backbone.conv1.weight"
+        weight = state_dict.get(key)
+        if (
+            weight is not None
+            and weight.shape[1] == 3
+            and self.backbone.conv1.in_channels == 1
+        ):
+            state_dict[key] = weight.sum(dim=1, keepdim=True)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, x_in, low_level):
         """
         Args:
@@ -16,6 +16,7 @@ from torch.utils.data import DataLoader
 from config import ex
 from dataloaders.dataset_specifics import *
 from dataloaders.datasets import TestDataset
+from dataloaders.prefetcher import Prefetcher
 from models.fewshot import FewShotSeg
 from utils import *
 
@@ -71,17 +72,26 @@ def main(_run, _config, _log):
         "min_size": _config["min_size"],
         "max_slices": _config["max_slices"],
         "supp_idx": _config["supp_idx"],
+        "cache_dir": _config["cache_dir"],
+        "test_cache_mb": _config["test_cache_mb"],
     }
     test_dataset = TestDataset(data_config)
+    # Volumes are read in the main process (num_workers=0), so that its LRU cache is shared
+    # by all test classes: DataLoader workers would each start with an empty cache, every
+    # class pass. Reading overlaps with inference through the prefetch thread below.
     test_loader = DataLoader(
         test_dataset,
         batch_size=_config["batch_size"],
         shuffle=False,
-        num_workers=_config["num_workers"],
+        num_workers=0,
         pin_memory=True,
         drop_last=True,
     )
 
+    # next query volumes read and resized in the background during inference
+    test_batches = Prefetcher(test_loader, "cpu", _config["n_test_prefetch"])
+    total_wait_time = 0.0
+
     # Get unique labels (classes).
     labels = get_label_names(_config["dataset"])
 
@@ -115,19 +125,25 @@ def main(_run, _config, _log):
             support_image = [
                 support_sample["image"][[i]].float()
                 for i in range(support_sample["image"].shape[0])
-            ]  # n_shot x 3 x H x W
+            ]  # n_shot x 1 x H x W
             support_fg_mask = [
                 support_sample["label"][[i]].float()
                 for i in range(support_sample["image"].shape[0])
             ]  # n_shot x H x W
 
+            # Encode the support slice of each sub-chunck once for all query slices.
+            support_states = [
+                model.encode_support([[support_image[k]]], [[support_fg_mask[k]]])
+                for k in range(_config["n_part"])
+            ]
+
             # Loop through query volumes.
             scores = Scores()
-            for i, sample in enumerate(test_loader):
+            for i, sample in enumerate(test_batches):
                 # Unpack query data.
                 query_image = [
                     sample["image"][i].float() for i in range(sample["image"].shape[0])
-                ]  # [C x 3 x H x W]
+                ]  # [C x 1 x H x W]
                 query_label = sample["label"].long()  # C x H x W
                 query_id = sample["id"][0].split("image_")[1][: -len(".nii.gz")]
 
@@ -137,22 +153,20 @@ def main(_run, _config, _log):
                 C_q = sample["image"].shape[1]
                 idx_ = np.linspace(0, C_q, _config["n_part"] + 1).astype("int")
                 for sub_chunck in range(_config["n_part"]):
-                    support_image_s = [support_image[sub_chunck]]  # 1 x 3 x H x W
-                    support_fg_mask_s = [support_fg_mask[sub_chunck]]  # 1 x H x W
-
                     query_image_s = query_image[0][
                         idx_[sub_chunck] : idx_[sub_chunck + 1]
-                    ]  # C' x 3 x H x W
+                    ]  # C' x 1 x H x W
 
+                    # Batches of query slices segmented in one call.
+                    n_batch = model.get_query_batch_size(
+                        query_image_s.shape[-2:], _config["query_batch_mb"]
+                    )
                     query_pred_s = []
-                    for i in range(query_image_s.shape[0]):
-                        _pred_s, _ = model(
-                            [support_image_s],
-                            [support_fg_mask_s],
-                            [query_image_s[[i]]],
-                            train=False,
+                    for start in range(0, query_image_s.shape[0], n_batch):
+                        _pred_s = model.segment(
+                            support_states[sub_chunck],
+                            [query_image_s[start : start + n_batch]],
                             n_cmat=5,
-                            n_iters=_config["n_iters"],
                         )  # C x 2 x H x W
 
                         query_pred_s.append(_pred_s)
@@ -190,10 +204,13 @@ def main(_run, _config, _log):
             _log.info(f"Test Class: {label_name}")
             _log.info(f"Mean class IoU: {class_iou[label_name]}")
             _log.info(f"Mean class Dice: {class_dice[label_name]}")
+            _log.info(f"Time waiting for query volumes: {test_batches.wait_time:.1f}s")
+            total_wait_time += test_batches.wait_time
 
     _log.info("Final results...")
     _log.info(f"Mean IoU: {class_iou}")
     _log.info(f"Mean Dice: {class_dice}")
+    _log.info(f"Total time waiting for query volumes: {total_wait_time:.1f}s")
 
     _log.info("End of validation.")
     return 1
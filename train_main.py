@@ -12,16 +12,177 @@ import shutil
 import torch
 import torch.backends.cudnn as cudnn
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim
 from torch.optim.lr_scheduler import MultiStepLR
 from torch.utils.data import DataLoader
 
 from config import ex
+from dataloaders.batch_augment import BatchAugment
+from dataloaders.datasets import (
+    TRAIN_SHAPE,
+    EpisodeMixin,
+    get_train_dirs,
+    read_train_volume,
+)
 from dataloaders.datasets import TrainDataset as TrainDataset
+from dataloaders.episode_bank import BankDataset, ReplaySampler, write_episode_bank
+from dataloaders.feature_cache import FeatureDataset, write_feature_cache
+from dataloaders.loss_sampler import LossAwareSampler
+from dataloaders.manifest import get_fold_volumes
+from dataloaders.prefetcher import Prefetcher, episode_collate
+from dataloaders.resampling import set_num_threads
+from dataloaders.shards import ShardedTrainDataset, write_shards
+from dataloaders.supervoxels import build_supervoxels as write_supervoxels
 from models.fewshot import FewShotSeg
 from utils import *
 
 
+def get_data_config(_config):
+    return {
+        "data_dir": _config["path"][_config["dataset"]]["data_dir"],
+        "dataset": _config["dataset"],
+        "n_shot": _config["n_shot"],
+        "n_way": _config["n_way"],
+        "n_query": _config["n_query"],
+        "n_sv": _config["n_sv"],
+        "sv_compactness": _config["sv_compactness"],
+        "max_iter": _config["max_iters_per_load"],
+        "eval_fold": _config["eval_fold"],
+        "min_size": _config["min_size"],
+        "max_slices": _config["max_slices"],
+        "roi_size": _config["roi_size"],
+        "roi_margin": _config["roi_margin"],
+        "test_label": _config["test_label"],
+        "exclude_label": _config["exclude_label"],
+        "use_gt": _config["use_gt"],
+        "episode_weighting": _config["episode_weighting"],
+        "episode_sampling": _config["episode_sampling"],
+        "cache_dir": _config["cache_dir"],
+        "n_load_workers": _config["n_load_workers"],
+        "resample_threads": _config["resample_threads"],
+        "max_volumes_in_memory": _config["max_volumes_in_memory"],
+        "shard_dir": _config["shard_dir"],
+        "episodes_per_volume": _config["episodes_per_volume"],
+        "episode_bank": _config["episode_bank"],
+        "feature_cache": _config["feature_cache"],
+        "batch_augment": _config["batch_augment"],
+        "n_elastic_fields": _config["n_elastic_fields"],
+        "elastic_bank_path": _config["elastic_bank_path"],
+    }
+
+
+@ex.command
+def build_shards(_config, _log):
+    """
+    Pack the training volumes of the current fold into shards in shard_dir
+    """
+    volumes = get_fold_volumes(
+        _config["path"][_config["dataset"]]["data_dir"],
+        _config["dataset"],
+        _config["eval_fold"],
+        train=True,
+        cache_dir=_config["cache_dir"],
+    )
+    image_dirs, label_dirs = get_train_dirs(volumes)
+    set_num_threads(_config["resample_threads"])  # this process only resizes volumes
+    _log.info(f"Writing {len(image_dirs)} volumes to {_config['shard_dir']}...")
+    write_shards(
+        image_dirs,
+        label_dirs,
+        _config["shard_dir"],
+        cache_dir=_config["cache_dir"],
+        shard_size_mb=_config["shard_size_mb"],
+    )
+
+
+@ex.command
+def build_supervoxels(_config, _log):
+    """
+    Generate the supervoxels of the training volumes of the current fold into cache_dir
+    """
+    volumes = get_fold_volumes(
+        _config["path"][_config["dataset"]]["data_dir"],
+        _config["dataset"],
+        _config["eval_fold"],
+        train=True,
+        cache_dir=_config["cache_dir"],
+    )
+    image_dirs, _ = get_train_dirs(volumes)
+    _log.info(f"Generating {_config['n_sv']} supervoxels for {len(image_dirs)} volumes...")
+    write_supervoxels(
+        image_dirs,
+        TRAIN_SHAPE,
+        _config["cache_dir"],
+        _config["n_sv"],
+        compactness=_config["sv_compactness"],
+        n_workers=_config["n_load_workers"],
+        n_threads=_config["resample_threads"],
+    )
+
+
+@ex.command
+def build_episode_bank(_config, _log):
+    """
+    Generate n_bank_episodes training episodes of the current fold into episode_bank
+    """
+    if _config["seed"] is not None:
+        random.seed(_config["seed"])
+        torch.manual_seed(_config["seed"])  # seeds the episode generators of the workers
+    data_config = get_data_config(_config)
+    data_config["episode_sampling"] = "random"  # the bank's indices are not table rows
+    train_dataset = TrainDataset(data_config)
+    _log.info(
+        f"Writing {_config['n_bank_episodes']} episodes to {_config['episode_bank']}..."
+    )
+    write_episode_bank(
+        train_dataset,
+        _config["n_bank_episodes"],
+        _config["episode_bank"],
+        num_workers=_config["num_workers"],
+    )
+
+
+@ex.command
+def build_feature_cache(_config, _log):
+    """
+    Encode the training slices of the current fold into feature_cache, with the encoder of
+    reload_model_path (or the pretrained encoder if None)
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = FewShotSeg()
+    if _config["reload_model_path"] is not None:
+        model.load_state_dict(torch.load(_config["reload_model_path"], map_location="cpu"))
+    encoder = model.encoder.to(device).eval()
+
+    data_config = get_data_config(_config)
+    volumes = get_fold_volumes(
+        data_config["data_dir"],
+        _config["dataset"],
+        _config["eval_fold"],
+        train=True,
+        cache_dir=_config["cache_dir"],
+    )
+    image_dirs, label_dirs = get_train_dirs(volumes)
+    _log.info(
+        f"Encoding {len(image_dirs)} volumes x {_config['n_feature_augment'] + 1}"
+        f" augmentations to {_config['feature_cache']}..."
+    )
+    write_feature_cache(
+        encoder,
+        EpisodeMixin(data_config),
+        lambda image_dir, label_dir: read_train_volume(
+            image_dir, label_dir, _config["cache_dir"]
+        ),
+        image_dirs,
+        label_dirs,
+        _config["feature_cache"],
+        n_augment=_config["n_feature_augment"],
+        seed=_config["seed"] or 0,
+        device=device,
+    )
+
+
 @ex.automain
 def main(_run, _config, _log):
     if _run.observers:
@@ -63,10 +224,21 @@ def main(_run, _config, _log):
 
     _log.info("Create model...")
     model = FewShotSeg().to(device)
+    if _config["reload_model_path"] is not None:
+        model.load_state_dict(
+            torch.load(_config["reload_model_path"], map_location=device)
+        )
     model.train()
+    if _config["feature_cache"] is not None:
+        # only the CMAT head is trained on the cached features
+        model.encoder.requires_grad_(False)
+        model.encoder.eval()
 
     _log.info("Set optimizer...")
-    optimizer = torch.optim.SGD(model.parameters(), **_config["optim"])
+    optimizer = torch.optim.SGD(
+        [param for param in model.parameters() if param.requires_grad],
+        **_config["optim"],
+    )
     lr_milestones = [
         (ii + 1) * _config["max_iters_per_load"]
         for ii in range(_config["n_steps"] // _config["max_iters_per_load"] - 1)
@@ -79,31 +251,60 @@ def main(_run, _config, _log):
     criterion = nn.NLLLoss(ignore_index=255, weight=my_weight)
 
     _log.info("Load data...")
-    data_config = {
-         "data_dir": _config['path'][_config['dataset']]['data_dir'],
-        "dataset": _config["dataset"],
-        "n_shot": _config["n_shot"],
-        "n_way": _config["n_way"],
-        "n_query": _config["n_query"],
-        "n_sv": _config["n_sv"],
-        "max_iter": _config["max_iters_per_load"],
-        "eval_fold": _config["eval_fold"],
-        "min_size": _config["min_size"],
-        "max_slices": _config["max_slices"],
-        "test_label": _config["test_label"],
-        "exclude_label": _config["exclude_label"],
-        "use_gt": _config["use_gt"],
-    }
-    train_dataset = TrainDataset(data_config)
+    data_config = get_data_config(_config)
+    sampler = None
+    if _config["feature_cache"] is not None:
+        train_dataset = FeatureDataset(data_config)
+    elif _config["episode_bank"] is not None:
+        train_dataset = BankDataset(data_config)
+        sampler = ReplaySampler(_config["max_iters_per_load"])
+    elif _config["shard_dir"] is not None:
+        train_dataset = ShardedTrainDataset(data_config)
+    else:
+        train_dataset = TrainDataset(data_config)
+    loss_sampler = None
+    if _config["episode_sampling"] == "loss":
+        if not isinstance(train_dataset, TrainDataset):
+            raise ValueError(
+                "episode_sampling='loss' requires shard_dir=None and episode_bank=None"
+            )
+        loss_sampler = LossAwareSampler(
+            train_dataset,
+            _config["max_iters_per_load"],
+            temperature=_config["sampling_temperature"],
+            floor=_config["sampling_floor"],
+            momentum=_config["loss_momentum"],
+        )
+        sampler = loss_sampler
     train_loader = DataLoader(
         train_dataset,
         batch_size=_config["batch_size"],
-        shuffle=True,
+        shuffle=sampler is None and isinstance(train_dataset, TrainDataset),
+        sampler=sampler,
         num_workers=_config["num_workers"],
+        collate_fn=episode_collate,
         pin_memory=True,
         drop_last=True,
+        # keep workers across sub-epochs, unless they have to see a new volume window
+        persistent_workers=_config["num_workers"] > 0
+        and _config["max_volumes_in_memory"] is None,
     )
 
+    # next batches prepared and copied to the device during the current training step
+    train_batches = Prefetcher(train_loader, device, _config["n_prefetch"])
+    batch_augment = None
+    if _config["batch_augment"] and _config["feature_cache"] is None:
+        batch_augment = BatchAugment(seed=_config["seed"])
+    if isinstance(train_dataset, BankDataset):
+        if train_dataset.augmented and batch_augment is not None:
+            _log.info("The episode bank is already augmented, batch_augment is skipped")
+            batch_augment = None
+        elif not train_dataset.augmented and batch_augment is None:
+            raise ValueError(
+                "The episode bank was written with batch_augment=True and holds unaugmented"
+                " episodes, train it with batch_augment=True"
+            )
+
     n_sub_epochs = (
         _config["n_steps"] // _config["max_iters_per_load"]
     )  # number of times for reloading
@@ -114,45 +315,65 @@ def main(_run, _config, _log):
     _log.info(f"Running on the device: {device}")
     for sub_epoch in range(n_sub_epochs):
         _log.info(f'This is epoch "{sub_epoch + 1}" of "{n_sub_epochs}" epochs.')
-        for _, sample in enumerate(train_loader):
-            # Prepare episode data.
-            support_images = [
-                [shot.float().to(device) for shot in way]
-                for way in sample["support_images"]
-            ]
-            support_fg_mask = [
-                [shot.float().to(device) for shot in way]
-                for way in sample["support_fg_labels"]
-            ]
-
-            query_images = [
-                query_image.float().to(device) for query_image in sample["query_images"]
-            ]
-            query_labels = torch.cat(
-                [
-                    query_label.long().to(device)
-                    for query_label in sample["query_labels"]
-                ],
-                dim=0,
-            )
+        # rolling volume window: switch to the window loaded during the last epoch
+        if isinstance(train_dataset, TrainDataset):
+            if sub_epoch > 0:
+                train_dataset.swap_window()
+            if sub_epoch < n_sub_epochs - 1:
+                train_dataset.prefetch_window()
+        for _, sample in enumerate(train_batches):
+            if batch_augment is not None:
+                sample = batch_augment(sample)
+
+            # Prepare episode data (already on the device, see episode_collate).
+            support_fg_mask = [list(way) for way in sample["support_fg_labels"]]
+            query_labels = sample["query_labels"].flatten(0, 1)  # (N * B) x H x W
 
             # Compute outputs and losses.
-            query_pred, align_loss = model(
-                support_images, support_fg_mask, query_images, train=True, n_cmat=5
-            )
+            if _config["feature_cache"] is not None:
+                # frozen encoder: precomputed fp16 features
+                query_pred, align_loss = model.forward_features(
+                    sample["support_features"].float(),
+                    support_fg_mask,
+                    sample["query_features"].float(),
+                    query_labels.shape[-2:],
+                    train=True,
+                    n_cmat=5,
+                )
+            else:
+                support_images = [list(way) for way in sample["support_images"]]
+                query_images = list(sample["query_images"])
+                query_pred, align_loss = model(
+                    support_images, support_fg_mask, query_images, train=True, n_cmat=5
+                )
 
-            query_loss = criterion(
-                torch.log(
-                    torch.clamp(
-                        query_pred,
-                        torch.finfo(torch.float32).eps,
-                        1 - torch.finfo(torch.float32).eps,
-                    )
-                ),
-                query_labels,
+            query_log_prob = torch.log(
+                torch.clamp(
+                    query_pred,
+                    torch.finfo(torch.float32).eps,
+                    1 - torch.finfo(torch.float32).eps,
+                )
             )
+            query_loss = criterion(query_log_prob, query_labels)
             loss = query_loss + align_loss
 
+            # Feed the loss of every episode back to the loss-aware sampler.
+            if loss_sampler is not None:
+                with torch.no_grad():
+                    pixel_loss = F.nll_loss(
+                        query_log_prob,
+                        query_labels,
+                        weight=my_weight,
+                        ignore_index=255,
+                        reduction="none",
+                    )  # (N * B) x H x W
+                    episode_loss = pixel_loss.view(
+                        -1, sample["episode_ids"].shape[0], pixel_loss[0].numel()
+                    ).mean(dim=(0, 2))
+                loss_sampler.update(
+                    sample["episode_ids"].cpu().numpy(), episode_loss.cpu().numpy()
+                )
+
             # Compute gradient and do SGD step.
             for param in model.parameters():
                 param.grad = None